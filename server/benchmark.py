@@ -0,0 +1,221 @@
+import json
+import os
+import platform
+import statistics
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from random import Random
+
+from absl import app
+from absl import flags
+
+from ecdsa import SigningKey, NIST256p
+
+from common import convert_to_diagnosis_key, FORMAT_RFC3339
+from generate_diagnosis_keys import _compress_zip, _export_generate, _export_tek_signs
+from signer import create_signer, BACKEND_AUTO
+from sorter import _exposure_window_key, _sort_exposure_windows_vectorized, sort_exposure_windows, \
+    sort_scan_instances
+from synthetic import generate_diagnosis_keys_payload, generate_export_keys, generate_exposure_windows, \
+    generate_scan_instances
+
+FLAGS = flags.FLAGS
+flags.DEFINE_list("key_counts", ["10", "1000", "10000", "100000"], "Numbers of diagnosis-keys")
+flags.DEFINE_list("window_counts", ["10", "100", "1000", "10000"], "Numbers of exposure windows")
+flags.DEFINE_list("benchmarks", None, "Benchmarks to run (default: all)")
+flags.DEFINE_integer("iterations", 5, "Measured runs per benchmark and scale. The median is reported")
+flags.DEFINE_integer("seed", 0, "Random seed for the synthetic payloads")
+flags.DEFINE_string("signing_key_path", None, "Signing key(PEM). A temporary key is generated when omitted")
+flags.DEFINE_string("signing_backend", BACKEND_AUTO, "Signing backend: auto, ecdsa or openssl")
+flags.DEFINE_string("output_path", None, "File to which the results are written as JSON")
+flags.DEFINE_string("baseline_path", None, "Results of an earlier run to compare with")
+flags.DEFINE_float("tolerance", 0.1, "Slowdown against the baseline reported as a regression (0.1 = 10%)")
+
+REGION = '440'
+CLUSTER_ID = '012345'
+
+KEYS = 'keys'
+WINDOWS = 'windows'
+SCAN_INSTANCES = 'scan_instances'
+
+
+# Each benchmark is (name, unit, setup, run): setup(rand, scale, context) returns the input of run(input),
+# and is neither timed nor traced.
+
+def _setup_sort_exposure_windows(rand, scale, context):
+    return generate_exposure_windows(rand, scale)
+
+
+def _run_sort_exposure_windows(exposure_windows):
+    # Sorting replaces the scan instances of each window with a sorted list, so every run sorts shallow copies.
+    sort_exposure_windows(list(map(dict, exposure_windows)))
+
+
+def _setup_sort_scan_instances(rand, scale, context):
+    return generate_scan_instances(rand, scale)
+
+
+def _setup_convert_to_diagnosis_key(rand, scale, context):
+    payload = generate_diagnosis_keys_payload(rand, scale)
+    symptom_onset_date = datetime.strptime(payload['symptomOnsetDate'], FORMAT_RFC3339)
+    return payload['temporaryExposureKeys'], symptom_onset_date, payload['idempotencyKey']
+
+
+def _run_convert_to_diagnosis_key(args):
+    keys, symptom_onset_date, idempotency_key = args
+    for key in keys:
+        convert_to_diagnosis_key(key, CLUSTER_ID, symptom_onset_date, idempotency_key)
+
+
+def _setup_export_generate(rand, scale, context):
+    return generate_export_keys(rand, scale)
+
+
+def _setup_export_tek_signs(rand, scale, context):
+    return _export_generate(CLUSTER_ID, REGION, generate_export_keys(rand, scale)), context['signer']
+
+
+def _setup_compress_zip(rand, scale, context):
+    export_bin = _export_generate(CLUSTER_ID, REGION, generate_export_keys(rand, scale))
+    return export_bin, _export_tek_signs(export_bin, REGION, context['signer'])
+
+
+BENCHMARKS = [
+    ('sort_exposure_windows', WINDOWS, _setup_sort_exposure_windows, _run_sort_exposure_windows),
+    ('sort_scan_instances', SCAN_INSTANCES, _setup_sort_scan_instances, sort_scan_instances),
+    ('convert_to_diagnosis_key', KEYS, _setup_convert_to_diagnosis_key, _run_convert_to_diagnosis_key),
+    ('export_generate', KEYS, _setup_export_generate, lambda keys: _export_generate(CLUSTER_ID, REGION, keys)),
+    ('export_tek_signs', KEYS, _setup_export_tek_signs, lambda args: _export_tek_signs(args[0], REGION, args[1])),
+    ('compress_zip', KEYS, _setup_compress_zip, lambda args: _compress_zip(*args)),
+]
+
+
+def _scales(unit):
+    if unit == KEYS:
+        return list(map(int, FLAGS.key_counts))
+    # Scan instances are measured at the scale of the windows of the other sorter benchmark.
+    return list(map(int, FLAGS.window_counts))
+
+
+def _measure(run, input, iterations):
+    run(input)  # Warm up.
+
+    durations = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        run(input)
+        durations.append(time.perf_counter() - started)
+
+    # Traced apart from the timed runs, which tracemalloc would slow down.
+    tracemalloc.start()
+    try:
+        run(input)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return statistics.median(durations), peak
+
+
+def _check_sorter_equivalence(rand):
+    # The vectorized path must order exposure windows exactly like sorted() with the same keys.
+    for scale in _scales(WINDOWS):
+        exposure_windows = generate_exposure_windows(rand, scale, max_scan_instances=3)
+        for ew in exposure_windows:
+            ew['ScanInstances'] = sort_scan_instances(ew['ScanInstances'])
+        expected = sorted(exposure_windows, key=_exposure_window_key, reverse=True)
+        assert _sort_exposure_windows_vectorized(exposure_windows) == expected, \
+            'Vectorized sort differs from sorted() at %d exposure windows' % scale
+
+
+def _compare(results, baseline):
+    baseline_seconds = {(result['name'], result['scale']): result['seconds'] for result in baseline['results']}
+
+    regressions = []
+    print()
+    print('%-26s %8s %12s %12s %8s' % ('benchmark', 'scale', 'baseline ms', 'ms', 'ratio'))
+    for result in results:
+        key = (result['name'], result['scale'])
+        if key not in baseline_seconds:
+            continue
+        ratio = result['seconds'] / baseline_seconds[key] if baseline_seconds[key] > 0 else float('inf')
+        regressed = ratio > 1 + FLAGS.tolerance
+        if regressed:
+            regressions.append(key)
+        print('%-26s %8d %12.3f %12.3f %8.2f%s' % (
+            result['name'], result['scale'], baseline_seconds[key] * 1000, result['seconds'] * 1000, ratio,
+            ' REGRESSION' if regressed else ''))
+
+    return regressions
+
+
+def main(argv):
+    del argv  # Unused.
+
+    signing_key_path = FLAGS.signing_key_path
+    temporary_key_path = None
+    if signing_key_path is None:
+        fd, temporary_key_path = tempfile.mkstemp(suffix='.pem')
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(SigningKey.generate(curve=NIST256p).to_pem())
+        signing_key_path = temporary_key_path
+
+    try:
+        signer = create_signer(signing_key_path, FLAGS.signing_backend)
+    finally:
+        if temporary_key_path is not None:
+            os.remove(temporary_key_path)
+
+    context = {'signer': signer}
+
+    _check_sorter_equivalence(Random(FLAGS.seed))
+
+    results = []
+    print('%-26s %8s %12s %14s %12s' % ('benchmark', 'scale', 'ms', 'items/s', 'peak KiB'))
+    for name, unit, setup, run in BENCHMARKS:
+        if FLAGS.benchmarks is not None and name not in FLAGS.benchmarks:
+            continue
+        for scale in _scales(unit):
+            input = setup(Random(FLAGS.seed), scale, context)
+            seconds, peak = _measure(run, input, FLAGS.iterations)
+            result = {
+                'name': name,
+                'unit': unit,
+                'scale': scale,
+                'seconds': seconds,
+                'items_per_sec': scale / seconds if seconds > 0 else None,
+                'peak_bytes': peak,
+            }
+            results.append(result)
+            print('%-26s %8d %12.3f %14.0f %12.1f' % (
+                name, scale, seconds * 1000, result['items_per_sec'] or 0, peak / 1024))
+
+    report = {
+        'created': int(time.time()),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'signer': signer.name,
+        'seed': FLAGS.seed,
+        'iterations': FLAGS.iterations,
+        'results': results,
+    }
+
+    if FLAGS.output_path is not None:
+        with open(FLAGS.output_path, mode='w') as fp:
+            json.dump(report, fp, indent=2)
+
+    if FLAGS.baseline_path is not None:
+        with open(FLAGS.baseline_path, mode='r') as fp:
+            baseline = json.load(fp)
+        regressions = _compare(results, baseline)
+        if len(regressions) > 0:
+            print('%d regressions over %d%%.' % (len(regressions), FLAGS.tolerance * 100))
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    app.run(main)
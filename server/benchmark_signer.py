@@ -0,0 +1,80 @@
+import hashlib
+import os
+import tempfile
+import time
+from random import Random
+
+from absl import app
+from absl import flags
+
+from ecdsa import SigningKey, NIST256p
+from ecdsa.util import sigdecode_der
+
+from generate_diagnosis_keys import _export_generate
+from signer import EcdsaSigner, OpenSSLSigner, is_openssl_available
+from synthetic import generate_export_keys
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string("signing_key_path", None, "Signing key(PEM). A temporary key is generated when omitted")
+flags.DEFINE_list("key_counts", ["10", "1000", "10000", "100000"], "Number of diagnosis-keys in export.bin")
+flags.DEFINE_integer("iterations", 20, "Signatures per backend and size")
+flags.DEFINE_integer("seed", 0, "Random seed for the synthetic diagnosis-keys")
+
+REGION = '440'
+CLUSTER_ID = '012345'
+
+
+def _generate_export_bin(rand, key_count):
+    return _export_generate(CLUSTER_ID, REGION, generate_export_keys(rand, key_count))
+
+
+def _verify(pem, signature, data):
+    # Both backends must emit X9.62 DER that the other side can verify.
+    verifying_key = SigningKey.from_pem(pem).get_verifying_key()
+    return verifying_key.verify(signature, data, hashfunc=hashlib.sha256, sigdecode=sigdecode_der)
+
+
+def _measure(signer, data, iterations):
+    started = time.perf_counter()
+    for _ in range(iterations):
+        signer.sign(data)
+    return (time.perf_counter() - started) / iterations
+
+
+def main(argv):
+    del argv  # Unused.
+
+    signing_key_path = FLAGS.signing_key_path
+    temporary_key_path = None
+    if signing_key_path is None:
+        fd, temporary_key_path = tempfile.mkstemp(suffix='.pem')
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(SigningKey.generate(curve=NIST256p).to_pem())
+        signing_key_path = temporary_key_path
+
+    try:
+        with open(signing_key_path) as fp:
+            pem = fp.read()
+
+        signers = [EcdsaSigner(pem)]
+        if is_openssl_available():
+            signers.append(OpenSSLSigner(pem))
+        else:
+            print('cryptography is not installed. Only the ecdsa backend is measured.')
+
+        rand = Random(FLAGS.seed)
+
+        print('%-8s %10s %12s %14s' % ('backend', 'keys', 'bytes', 'ms/signature'))
+        for key_count in map(int, FLAGS.key_counts):
+            data = _generate_export_bin(rand, key_count)
+            for signer in signers:
+                assert _verify(pem, signer.sign(data), data), '%s produced an invalid signature' % signer.name
+                elapsed = _measure(signer, data, FLAGS.iterations)
+                print('%-8s %10d %12d %14.3f' % (signer.name, key_count, len(data), elapsed * 1000))
+    finally:
+        if temporary_key_path is not None:
+            os.remove(temporary_key_path)
+
+
+if __name__ == '__main__':
+    app.run(main)
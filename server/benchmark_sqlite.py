@@ -0,0 +1,278 @@
+import json
+import multiprocessing
+import os
+import queue
+import shutil
+import statistics
+import tempfile
+import time
+from datetime import datetime
+from random import Random
+
+from absl import app
+from absl import flags
+
+from ecdsa import SigningKey, NIST256p
+
+FLAGS = flags.FLAGS
+flags.DEFINE_integer("duration_sec", 10, "Length of the run of each profile")
+flags.DEFINE_integer("uploaders", 4, "Processes that put diagnosis-keys like uwsgi workers")
+flags.DEFINE_integer("readers", 2, "Processes that read diagnosis-keys like list and export queries")
+flags.DEFINE_integer("keys_per_upload", 14, "Diagnosis-keys per upload")
+flags.DEFINE_integer("initial_keys", 100000, "Diagnosis-keys in the database before the run, exported by its first export")
+flags.DEFINE_float("export_interval_sec", 1.0, "Pause between the exports of the exporter. Negative disables it")
+flags.DEFINE_integer("clusters", 3, "Number of clusters")
+flags.DEFINE_list("profiles", None, "Profiles to run (default: all)")
+flags.DEFINE_integer("seed", 0, "Random seed")
+flags.DEFINE_string("output_path", None, "File to which the results are written as JSON")
+
+REGION = 440
+
+# Each profile adds one setting of the default connection profile to the one before it,
+# starting from a connection on which nothing is set.
+PROFILES = [
+    ('none', {
+        'db_busy_timeout_in_ms': None, 'db_journal_mode': None, 'db_synchronous': None, 'db_mmap_size': None,
+        'db_cache_size': None,
+    }),
+    ('busy_timeout', {
+        'db_journal_mode': None, 'db_synchronous': None, 'db_mmap_size': None, 'db_cache_size': None,
+    }),
+    ('journal_mode', {'db_synchronous': None, 'db_mmap_size': None, 'db_cache_size': None}),
+    ('synchronous', {'db_mmap_size': None, 'db_cache_size': None}),
+    ('mmap_size', {'db_cache_size': None}),
+    ('cache_size', {}),
+]
+
+UPLOAD = 'upload'
+READ = 'read'
+EXPORT = 'export'
+
+
+def _init(config_obj):
+    from configuration import Configuration
+    from database import init_engine_from_configuration
+    from scheme import Base
+
+    config = Configuration(config_obj)
+    engine = init_engine_from_configuration(config)
+    Base.metadata.create_all(bind=engine)
+    return config
+
+
+def _is_lock_error(e):
+    return 'database is locked' in str(e)
+
+
+def _seed(config_obj, cluster_ids, key_count, seed):
+    from common import convert_to_diagnosis_key, insert_diagnosis_keys, FORMAT_RFC3339
+    from database import Session
+    from synthetic import generate_diagnosis_keys_payload
+
+    _init(config_obj)
+    rand = Random(seed)
+
+    session = Session()
+    try:
+        for index in range(0, key_count, 10000):
+            payload = generate_diagnosis_keys_payload(rand, min(10000, key_count - index))
+            symptom_onset_date = datetime.strptime(payload['symptomOnsetDate'], FORMAT_RFC3339)
+            cluster_id = cluster_ids[index // 10000 % len(cluster_ids)]
+            diagnosis_keys = [convert_to_diagnosis_key(key, cluster_id, symptom_onset_date, payload['idempotencyKey'])
+                              for key in payload['temporaryExposureKeys']]
+            insert_diagnosis_keys(session, cluster_id, diagnosis_keys)
+            session.commit()
+    finally:
+        session.close()
+
+
+def _upload(cluster_ids, keys_per_upload, seed):
+    from common import convert_to_diagnosis_key, insert_diagnosis_keys, FORMAT_RFC3339
+    from database import Session
+    from synthetic import generate_diagnosis_keys_payload
+
+    rand = Random(seed)
+    # The same work as put_diagnosis_keys, without the HTTP layer.
+    payload = generate_diagnosis_keys_payload(rand, keys_per_upload)
+    symptom_onset_date = datetime.strptime(payload['symptomOnsetDate'], FORMAT_RFC3339)
+    cluster_id = rand.choice(cluster_ids)
+    diagnosis_keys = [convert_to_diagnosis_key(key, cluster_id, symptom_onset_date, payload['idempotencyKey'])
+                      for key in payload['temporaryExposureKeys']]
+
+    session = Session()
+    try:
+        insert_diagnosis_keys(session, cluster_id, diagnosis_keys)
+        session.commit()
+    finally:
+        session.close()
+
+
+def _read(cluster_ids, rand):
+    from database import Session
+    from scheme import DiagnosisKey
+
+    session = Session()
+    try:
+        session.query(DiagnosisKey.key, DiagnosisKey.rollingStartNumber) \
+            .filter(DiagnosisKey.cluster_id == rand.choice(cluster_ids)) \
+            .order_by(DiagnosisKey.upload_id.desc()) \
+            .limit(1000) \
+            .all()
+    finally:
+        session.close()
+
+
+def _run_worker(role, config_obj, cluster_ids, seed, start, duration_sec, export_interval_sec, keys_per_upload,
+                results):
+    from sqlalchemy.exc import OperationalError
+
+    config = _init(config_obj)
+    if role == EXPORT:
+        from generate_diagnosis_keys import export_diagnosis_keys
+
+    rand = Random(seed)
+    latencies = []
+    lock_errors = 0
+    errors = 0
+
+    start.wait()
+    deadline = time.time() + duration_sec
+    while time.time() < deadline:
+        started = time.perf_counter()
+        try:
+            if role == UPLOAD:
+                _upload(cluster_ids, keys_per_upload, rand.getrandbits(32))
+            elif role == READ:
+                _read(cluster_ids, rand)
+            else:
+                export_diagnosis_keys(config)
+            latencies.append(time.perf_counter() - started)
+        except OperationalError as e:
+            if _is_lock_error(e):
+                lock_errors += 1
+            else:
+                errors += 1
+        except Exception:
+            errors += 1
+
+        if role == EXPORT:
+            time.sleep(export_interval_sec)
+
+    results.put((role, latencies, lock_errors, errors))
+
+
+def _percentile(sorted_values, percent):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * percent / 100))]
+
+
+def _run_profile(name, settings, base_path, signing_key_path, cluster_ids):
+    profile_path = os.path.join(base_path, name)
+    os.makedirs(profile_path)
+
+    config_obj = {
+        'region': REGION,
+        'base_url': 'http://localhost/',
+        'db_uri': 'sqlite:///%s' % os.path.join(profile_path, 'benchmark.db'),
+        'base_path': profile_path,
+        'export-generate_bin_path': '',
+        'signing_key_path': signing_key_path,
+    }
+    config_obj.update(settings)
+
+    # Every process starts from a fresh interpreter, as uwsgi workers and the cron exporter do.
+    context = multiprocessing.get_context('spawn')
+
+    seeder = context.Process(target=_seed, args=(config_obj, cluster_ids, FLAGS.initial_keys, FLAGS.seed))
+    seeder.start()
+    seeder.join()
+    assert seeder.exitcode == 0, 'Seeding %s failed.' % name
+
+    roles = [UPLOAD] * FLAGS.uploaders + [READ] * FLAGS.readers
+    if FLAGS.export_interval_sec >= 0:
+        roles.append(EXPORT)
+
+    start = context.Event()
+    results = context.Queue()
+    rand = Random(FLAGS.seed)
+    processes = [
+        context.Process(target=_run_worker, args=(
+            role, config_obj, cluster_ids, rand.getrandbits(32), start, FLAGS.duration_sec,
+            FLAGS.export_interval_sec, FLAGS.keys_per_upload, results))
+        for role in roles
+    ]
+    for process in processes:
+        process.start()
+
+    # Let every process import its modules and connect before the clock starts.
+    time.sleep(2)
+    start.set()
+
+    latencies = {role: [] for role in [UPLOAD, READ, EXPORT]}
+    lock_errors = {role: 0 for role in latencies.keys()}
+    errors = {role: 0 for role in latencies.keys()}
+    for _ in processes:
+        while True:
+            try:
+                role, role_latencies, role_lock_errors, role_errors = results.get(timeout=1)
+                break
+            except queue.Empty:
+                # A worker that died before putting its results would leave this waiting forever.
+                failed = [process for process in processes if process.exitcode not in [None, 0]]
+                assert len(failed) == 0, 'A worker of %s exited with %d.' % (name, failed[0].exitcode)
+        latencies[role].extend(role_latencies)
+        lock_errors[role] += role_lock_errors
+        errors[role] += role_errors
+    for process in processes:
+        process.join()
+
+    result = {'profile': name, 'settings': settings}
+    for role in latencies.keys():
+        sorted_latencies = sorted(latencies[role])
+        result[role] = {
+            'count': len(sorted_latencies),
+            'per_sec': len(sorted_latencies) / FLAGS.duration_sec,
+            'p50_ms': statistics.median(sorted_latencies) * 1000 if len(sorted_latencies) > 0 else None,
+            'p99_ms': _percentile(sorted_latencies, 99) * 1000 if len(sorted_latencies) > 0 else None,
+            'lock_errors': lock_errors[role],
+            'errors': errors[role],
+        }
+    return result
+
+
+def _format_ms(value):
+    return '%9.1f' % value if value is not None else '%9s' % '-'
+
+
+def main(argv):
+    del argv  # Unused.
+
+    base_path = tempfile.mkdtemp(prefix='en-benchmark-sqlite-')
+    try:
+        signing_key_path = os.path.join(base_path, 'private.pem')
+        with open(signing_key_path, mode='wb') as fp:
+            fp.write(SigningKey.generate(curve=NIST256p).to_pem())
+
+        cluster_ids = ['%06d' % (100000 + index) for index in range(FLAGS.clusters)]
+
+        results = []
+        print('%-14s %-7s %7s %8s %9s %9s %6s %6s' % (
+            'profile', 'role', 'count', '/s', 'p50 ms', 'p99 ms', 'locked', 'errors'))
+        for name, settings in PROFILES:
+            if FLAGS.profiles is not None and name not in FLAGS.profiles:
+                continue
+            result = _run_profile(name, settings, base_path, signing_key_path, cluster_ids)
+            results.append(result)
+            for role in [UPLOAD, READ, EXPORT]:
+                print('%-14s %-7s %7d %8.1f %s %s %6d %6d' % (
+                    name, role, result[role]['count'], result[role]['per_sec'], _format_ms(result[role]['p50_ms']),
+                    _format_ms(result[role]['p99_ms']), result[role]['lock_errors'], result[role]['errors']))
+
+        if FLAGS.output_path is not None:
+            with open(FLAGS.output_path, mode='w') as fp:
+                json.dump({'flags': FLAGS.flag_values_dict(), 'results': results}, fp, indent=2)
+    finally:
+        shutil.rmtree(base_path, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    app.run(main)
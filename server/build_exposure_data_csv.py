@@ -0,0 +1,75 @@
+import json
+import os
+import sys
+
+from scheme import ExposureData
+from common import publish_chunks
+from configuration import Configuration
+from database import Session, init_engine_from_configuration
+from exposure_data_csv import CSV_TYPES, DATASET_HEADER_PREFIX, encode_csv, encode_dataset_rows
+from exposure_data_store import SUFFIX_JSON, get_exposure_data_dir, resolve_file_path
+
+
+def _dataset_chunks(base_path, cluster_id, rows, name):
+    key, header, csv_rows = CSV_TYPES[name]
+
+    yield b''.join(encode_csv(DATASET_HEADER_PREFIX + header, []))
+
+    for row in rows:
+        file_path = resolve_file_path(base_path, cluster_id, row.identifier, SUFFIX_JSON)
+        if not os.path.exists(file_path):
+            print('%s of cluster %s is not found.' % (row.identifier, cluster_id))
+            continue
+
+        with open(file_path, mode='r') as fp:
+            json_obj = json.load(fp)
+
+        if json_obj.get(key) is not None:
+            yield encode_dataset_rows(row.identifier, row.createdAt, csv_rows(json_obj[key]))
+
+
+def build(base_path, cluster_id):
+    session = Session()
+    try:
+        rows = session.query(ExposureData.identifier, ExposureData.createdAt) \
+            .filter(ExposureData.cluster_id == cluster_id) \
+            .order_by(ExposureData.createdAt, ExposureData.id) \
+            .all()
+    finally:
+        session.close()
+
+    for name in CSV_TYPES.keys():
+        chunks = _dataset_chunks(base_path, cluster_id, rows, name)
+        for _ in publish_chunks(chunks, get_exposure_data_dir(base_path, cluster_id), name):
+            pass
+
+    print('Datasets of cluster %s have been built from %d exposure-data.' % (cluster_id, len(rows)))
+
+
+def main(argv):
+    assert 'CONFIG_PATH' in os.environ, 'Env "CONFIG_PATH" must be set.'
+
+    config_path = os.environ['CONFIG_PATH']
+
+    assert os.path.exists(config_path), 'Config path %s is not exist.' % config_path
+
+    config = None
+    with open(config_path, mode='r') as fp:
+        config = Configuration(json.load(fp))
+
+    init_engine_from_configuration(config)
+
+    session = Session()
+    try:
+        cluster_ids = [row.cluster_id for row in session.query(ExposureData.cluster_id).distinct()]
+    finally:
+        session.close()
+
+    for cluster_id in sorted(cluster_ids):
+        build(config.base_path, cluster_id)
+
+    print('Build completed.')
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,73 @@
+import json
+import os
+import shutil
+import sys
+
+import scan_instance_store
+from scheme import ExposureData
+from configuration import Configuration
+from database import Session, init_engine_from_configuration
+from exposure_data_store import SUFFIX_JSON, resolve_file_path
+
+
+def build(base_path, cluster_id):
+    shutil.rmtree(scan_instance_store.get_scan_instances_dir(base_path, cluster_id), ignore_errors=True)
+
+    session = Session()
+    try:
+        exposure_data_list = session.query(ExposureData) \
+            .filter(ExposureData.cluster_id == cluster_id) \
+            .order_by(ExposureData.id) \
+            .all()
+
+        for exposure_data in exposure_data_list:
+            file_path = resolve_file_path(base_path, cluster_id, exposure_data.identifier, SUFFIX_JSON)
+            if not os.path.exists(file_path):
+                print('%s of cluster %s is not found.' % (exposure_data.identifier, cluster_id))
+                continue
+
+            with open(file_path, mode='r') as fp:
+                json_obj = json.load(fp)
+
+            # ExposureData indexed by migrate_db.py have no device.
+            if exposure_data.device is None:
+                exposure_data.device = json_obj.get('id')
+
+            if json_obj.get('exposure_windows') is not None:
+                columns = scan_instance_store.to_columns(json_obj['exposure_windows'])
+                scan_instance_store.append(base_path, cluster_id, exposure_data.id, columns)
+
+        session.commit()
+    finally:
+        session.close()
+
+    print('Scan instances of cluster %s have been built from %d exposure-data.' % (cluster_id, len(exposure_data_list)))
+
+
+def main(argv):
+    assert 'CONFIG_PATH' in os.environ, 'Env "CONFIG_PATH" must be set.'
+
+    config_path = os.environ['CONFIG_PATH']
+
+    assert os.path.exists(config_path), 'Config path %s is not exist.' % config_path
+
+    config = None
+    with open(config_path, mode='r') as fp:
+        config = Configuration(json.load(fp))
+
+    init_engine_from_configuration(config)
+
+    session = Session()
+    try:
+        cluster_ids = [row.cluster_id for row in session.query(ExposureData.cluster_id).distinct()]
+    finally:
+        session.close()
+
+    for cluster_id in sorted(cluster_ids):
+        build(config.base_path, cluster_id)
+
+    print('Build completed.')
+
+
+if __name__ == '__main__':
+    main(sys.argv)
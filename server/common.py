@@ -1,14 +1,21 @@
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
+import os
+import tempfile
 import time
 
-from scheme import DiagnosisKey
+from scheme import DiagnosisKey, DiagnosisKeyUpload
 
 # RFC3339
 FORMAT_RFC3339 = "%Y-%m-%dT%H:%M:%S.%f%z"
 
+JST = timezone(timedelta(hours=9), 'Asia/Tokyo')
+
 TIMEWINDOW_IN_SEC = 60 * 10
 DEFAULT_TRANSMISSION_RISK = 4
 
+# Keep IN-clauses below SQLite's default SQLITE_MAX_VARIABLE_NUMBER(999).
+QUERY_CHUNK_SIZE = 500
+
 
 def convert_to_diagnosis_key(json_obj, cluster_id, symptom_onset_date, idempotency_key):
     diagnosis_key = DiagnosisKey()
@@ -46,8 +53,78 @@ def _gen_primary_key(idempotency_key, diagnosis_key):
     ])
 
 
-def is_exists(session, cluster_id, diagnosis_key):
-    return session.query(DiagnosisKey) \
-               .filter(DiagnosisKey.cluster_id == cluster_id) \
-               .filter(DiagnosisKey.key == diagnosis_key.key) \
-               .count() > 0
+def _chunks(items, size):
+    for index in range(0, len(items), size):
+        yield items[index:index + size]
+
+
+def filter_new_diagnosis_keys(session, cluster_id, diagnosis_keys):
+    unique_diagnosis_keys = {}
+    for diagnosis_key in diagnosis_keys:
+        unique_diagnosis_keys.setdefault(diagnosis_key.key, diagnosis_key)
+
+    existing_keys = set()
+    for chunk in _chunks(list(unique_diagnosis_keys.keys()), QUERY_CHUNK_SIZE):
+        rows = session.query(DiagnosisKey.key) \
+            .filter(DiagnosisKey.cluster_id == cluster_id) \
+            .filter(DiagnosisKey.key.in_(chunk)) \
+            .all()
+        existing_keys.update(map(lambda row: row.key, rows))
+
+    return [diagnosis_key for key, diagnosis_key in unique_diagnosis_keys.items() if key not in existing_keys]
+
+
+def insert_diagnosis_keys(session, cluster_id, diagnosis_keys):
+    new_diagnosis_keys = filter_new_diagnosis_keys(session, cluster_id, diagnosis_keys)
+
+    if len(new_diagnosis_keys) > 0:
+        upload = DiagnosisKeyUpload(cluster_id=cluster_id, createdAt=int(time.time()))
+        session.add(upload)
+        session.flush()
+
+        for diagnosis_key in new_diagnosis_keys:
+            diagnosis_key.upload_id = upload.id
+
+        session.execute(
+            DiagnosisKey.__table__.insert(),
+            list(map(lambda diagnosis_key: diagnosis_key.to_row(), new_diagnosis_keys))
+        )
+
+    return new_diagnosis_keys
+
+
+def publish_file(data, output_dir, file_name):
+    # Written under a hidden name and renamed, so that readers never see a partial file.
+    fd, temp_path = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=output_dir)
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(data)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.chmod(temp_path, 0o644)
+
+        output_path = os.path.join(output_dir, file_name)
+        os.replace(temp_path, output_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+    return output_path
+
+
+def publish_chunks(chunks, output_dir, file_name):
+    # Passes chunks through while writing them; the file is published only once every chunk has been written.
+    fd, temp_path = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=output_dir)
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            for chunk in chunks:
+                fp.write(chunk)
+                yield chunk
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.chmod(temp_path, 0o644)
+
+        os.replace(temp_path, os.path.join(output_dir, file_name))
+    except BaseException:
+        os.remove(temp_path)
+        raise
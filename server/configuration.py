@@ -6,3 +6,26 @@ class Configuration:
         self.base_path = json_obj['base_path']
         self.export_generate_bin_path = json_obj['export-generate_bin_path']
         self.signing_key_path = json_obj['signing_key_path']
+        self.db_echo = json_obj.get('db_echo', False)
+        self.db_pool_class = json_obj.get('db_pool_class', None)
+        self.db_pool_size = json_obj.get('db_pool_size', None)
+        # SQLite connection profile. null leaves SQLite's default.
+        self.db_journal_mode = json_obj.get('db_journal_mode', 'WAL')
+        self.db_busy_timeout_in_ms = json_obj.get('db_busy_timeout_in_ms', 10000)
+        self.db_synchronous = json_obj.get('db_synchronous', 'NORMAL')
+        self.db_mmap_size = json_obj.get('db_mmap_size', 64 * 1024 * 1024)
+        self.db_cache_size = json_obj.get('db_cache_size', -16 * 1024)
+        self.export_max_keys_per_file = json_obj.get('export_max_keys_per_file', 10000)
+        self.export_workers = json_obj.get('export_workers', 1)
+        self.export_trigger_socket = json_obj.get('export_trigger_socket', None)
+        self.export_poll_interval_in_sec = json_obj.get('export_poll_interval_in_sec', 60)
+        self.export_debounce_in_sec = json_obj.get('export_debounce_in_sec', 5)
+        self.signing_backend = json_obj.get('signing_backend', 'auto')
+        self.log_level = json_obj.get('log_level', 'INFO')
+        self.export_metrics_path = json_obj.get('export_metrics_path', None)
+        self.download_offload = json_obj.get('download_offload', None)
+        self.download_offload_prefix = json_obj.get('download_offload_prefix', '/')
+        self.exposure_data_eager_csv = json_obj.get('exposure_data_eager_csv', False)
+        self.ingest_journal_dir = json_obj.get('ingest_journal_dir', None)
+        self.ingest_flush_interval_in_sec = json_obj.get('ingest_flush_interval_in_sec', 1)
+        self.ingest_flush_max_keys = json_obj.get('ingest_flush_max_keys', 10000)
@@ -1,72 +1,173 @@
-import json
-import os
 import time
+from collections import defaultdict, deque
+from datetime import datetime, timedelta, timezone
 from random import Random
-from datetime import datetime
 
 from absl import app
 from absl import flags
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, scoped_session
-
-from common import convert_to_diagnosis_key, is_exists, FORMAT_RFC3339
-from scheme import Base
+from common import convert_to_diagnosis_key, filter_new_diagnosis_keys, TIMEWINDOW_IN_SEC
+from scheme import Base, DiagnosisKey, DiagnosisKeyUpload
+from database import Session, init_engine
+from synthetic import KEY_DAYS, ROLLING_PERIOD, generate_key, generate_uuid
 
 FLAGS = flags.FLAGS
 flags.DEFINE_string("db_path", "./test.db", "Database path")
-flags.DEFINE_string("cluster_id", '123456', "Cluster ID")
-flags.DEFINE_string("input_json_path", "./sample/diagnosis_keys.json", "Sample JSON path")
+flags.DEFINE_bool("echo", False, "Log SQL statements")
+flags.DEFINE_integer("seed", 0, "Random seed. The same seed generates the same database")
+flags.DEFINE_integer("keys", 100000, "Number of diagnosis-keys to generate, duplicates included")
+flags.DEFINE_integer("clusters", 1, "Number of clusters")
+flags.DEFINE_string("cluster_id", '123456', "ID of the first cluster. The others follow it")
+flags.DEFINE_integer("max_keys_per_upload", KEY_DAYS, "Keys of one upload: one per day, 1 to this many")
+flags.DEFINE_string("end_date", '2021-09-16', "Date of the newest upload (YYYY-MM-DD, UTC)")
+flags.DEFINE_integer("days", 14, "Uploads are spread over this many days up to end_date")
+flags.DEFINE_enum("rolling_start_distribution", 'uniform', ['uniform', 'recent'],
+                  "Distribution of the upload dates, from which rollingStartNumber of the keys count back. "
+                  "'recent' makes each day rolling_start_decay times as likely as the day after it")
+flags.DEFINE_float("rolling_start_decay", 0.8, "Decay of the 'recent' distribution")
+flags.DEFINE_list("report_type_weights", ["0", "1", "0", "0", "0", "0"],
+                  "Relative weights of reportType 0(UNKNOWN) to 5(REVOKED)")
+flags.DEFINE_list("onset_days", ["0", "7"], "Range of days between the symptom onset and the upload date")
+flags.DEFINE_float("duplicate_rate", 0.0, "Rate of keys that are re-uploads of a recent key of the same cluster")
+flags.DEFINE_integer("batch_size", 1000, "Uploads inserted per transaction")
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+# Re-uploaded keys are drawn from this many most recent keys of the cluster.
+RECENT_KEYS = 1000
+
+
+def _day_weights():
+    if FLAGS.rolling_start_distribution == 'uniform':
+        return [1.0] * FLAGS.days
+    # Index 0 is end_date.
+    return [FLAGS.rolling_start_decay ** day for day in range(FLAGS.days)]
+
+
+def _generate_upload(rand, cluster_id, end_date, day_weights, report_type_weights, recent_keys):
+    """Returns the keys of one upload as put by a client, whether each is a re-upload, and when it is put."""
+    days_ago = rand.choices(range(FLAGS.days), weights=day_weights)[0]
+    upload_date = end_date - timedelta(days=days_ago)
+    created_at = int(upload_date.timestamp()) + rand.randrange(SECONDS_PER_DAY)
+
+    onset_min, onset_max = map(int, FLAGS.onset_days)
+    symptom_onset_date = upload_date - timedelta(days=rand.randint(onset_min, onset_max))
+
+    newest_rolling_start_number = int(upload_date.timestamp()) // TIMEWINDOW_IN_SEC // ROLLING_PERIOD * ROLLING_PERIOD
+    keys = []
+    reuploaded = []
+    for day in range(rand.randint(1, FLAGS.max_keys_per_upload)):
+        if len(recent_keys) > 0 and rand.random() < FLAGS.duplicate_rate:
+            keys.append(rand.choice(recent_keys))
+            reuploaded.append(True)
+            continue
+
+        key = {
+            'key': generate_key(rand),
+            'rollingStartNumber': newest_rolling_start_number - ROLLING_PERIOD * day,
+            # The key of the upload date is still rolling.
+            'rollingPeriod': rand.randint(1, ROLLING_PERIOD) if day == 0 else ROLLING_PERIOD,
+            'reportType': rand.choices(range(len(report_type_weights)), weights=report_type_weights)[0],
+        }
+        keys.append(key)
+        reuploaded.append(False)
+        recent_keys.append(key)
+
+    return keys, reuploaded, symptom_onset_date, generate_uuid(rand), created_at
+
+
+def _insert_batch(session, uploads):
+    # Freshly generated keys are random 128 bits and always new. Only re-uploads are deduplicated,
+    # against the database like insert_diagnosis_keys and against the fresh keys of the batch.
+    new_keys_by_upload = defaultdict(list)
+    fresh_keys = defaultdict(set)
+    reuploaded_keys = defaultdict(list)
+    for index, (cluster_id, created_at, diagnosis_keys, reuploaded) in enumerate(uploads):
+        for diagnosis_key, is_reuploaded in zip(diagnosis_keys, reuploaded):
+            if is_reuploaded:
+                reuploaded_keys[cluster_id].append((index, diagnosis_key))
+            else:
+                new_keys_by_upload[index].append(diagnosis_key)
+                fresh_keys[cluster_id].add(diagnosis_key.key)
+
+    for cluster_id, indexed_keys in reuploaded_keys.items():
+        upload_indexes = {id(diagnosis_key): index for index, diagnosis_key in indexed_keys}
+        new_keys = filter_new_diagnosis_keys(session, cluster_id, [diagnosis_key for _, diagnosis_key in indexed_keys])
+        for diagnosis_key in new_keys:
+            if diagnosis_key.key not in fresh_keys[cluster_id]:
+                new_keys_by_upload[upload_indexes[id(diagnosis_key)]].append(diagnosis_key)
+
+    # Uploads without new keys are not recorded, as in insert_diagnosis_keys.
+    upload_rows = {}
+    for index in sorted(new_keys_by_upload.keys()):
+        cluster_id, created_at, _, _ = uploads[index]
+        upload_rows[index] = DiagnosisKeyUpload(cluster_id=cluster_id, createdAt=created_at)
+    session.add_all(upload_rows.values())
+    session.flush()
+
+    rows = []
+    for index, new_keys in new_keys_by_upload.items():
+        for diagnosis_key in new_keys:
+            diagnosis_key.upload_id = upload_rows[index].id
+            rows.append(diagnosis_key.to_row())
+    if len(rows) > 0:
+        session.execute(DiagnosisKey.__table__.insert(), rows)
+
+    return len(rows)
 
-MAX_DELAY_IN_SEC = 2
 
 def main(argv):
     del argv  # Unused.
 
-    assert os.path.exists(FLAGS.input_json_path), '%s not exists' % FLAGS.input_json_path
-
     db_uri = "sqlite:///%s" % FLAGS.db_path
-    engine = create_engine(
-        db_uri,
-        encoding="utf-8",
-        echo=True)
+    engine = init_engine(db_uri, echo=FLAGS.echo)
 
     Base.metadata.create_all(bind=engine)
 
-    with open(FLAGS.input_json_path, encoding="utf-8", mode='r') as fp:
-        data = fp.read()
-
-    rand = Random()
+    rand = Random(FLAGS.seed)
 
-    json_obj = json.loads(data)
-    idempotency_key = json_obj['idempotencyKey']
-    symptom_onset_date_str = json_obj['symptomOnsetDate']
-    symptom_onset_date = datetime.strptime(symptom_onset_date_str, FORMAT_RFC3339)
-    key_list = json_obj['temporaryExposureKeys']
+    end_date = datetime.strptime(FLAGS.end_date, '%Y-%m-%d').replace(tzinfo=timezone.utc)
+    day_weights = _day_weights()
+    report_type_weights = list(map(float, FLAGS.report_type_weights))
+    cluster_ids = ['%06d' % (int(FLAGS.cluster_id) + index) for index in range(FLAGS.clusters)]
+    recent_keys = {cluster_id: deque(maxlen=RECENT_KEYS) for cluster_id in cluster_ids}
 
-    diagnosis_keys = []
-    for key in key_list:
-        time.sleep(rand.random() * MAX_DELAY_IN_SEC)
-        diagnosis_keys.append(convert_to_diagnosis_key(key, FLAGS.cluster_id, symptom_onset_date, idempotency_key))
-
-    session = scoped_session(
-        sessionmaker(
-            autocommit=False,
-            autoflush=False,
-            bind=engine
-        )
-    )
-
-    filtered_diagnosis_keys = list(
-        filter(lambda diagnosis_key: not is_exists(session, FLAGS.cluster_id, diagnosis_key), diagnosis_keys)
-    )
+    started = time.perf_counter()
+    generated_count = 0
+    inserted_count = 0
+    upload_count = 0
 
+    session = Session()
     try:
-        session.bulk_save_objects(filtered_diagnosis_keys)
-        session.commit()
+        while generated_count < FLAGS.keys:
+            uploads = []
+            while len(uploads) < FLAGS.batch_size and generated_count < FLAGS.keys:
+                cluster_id = rand.choice(cluster_ids)
+                keys, reuploaded, symptom_onset_date, idempotency_key, created_at = _generate_upload(
+                    rand, cluster_id, end_date, day_weights, report_type_weights, recent_keys[cluster_id])
+                keys = keys[:FLAGS.keys - generated_count]
+                reuploaded = reuploaded[:len(keys)]
+
+                diagnosis_keys = []
+                for key in keys:
+                    diagnosis_key = convert_to_diagnosis_key(key, cluster_id, symptom_onset_date, idempotency_key)
+                    diagnosis_key.createdAt = created_at
+                    diagnosis_keys.append(diagnosis_key)
+
+                uploads.append((cluster_id, created_at, diagnosis_keys, reuploaded))
+                generated_count += len(keys)
+
+            inserted_count += _insert_batch(session, uploads)
+            upload_count += len(uploads)
+            session.commit()
+
+            print('%d / %d keys generated, %d inserted (%.0f keys/s).' % (
+                generated_count, FLAGS.keys, inserted_count, generated_count / (time.perf_counter() - started)))
     finally:
         session.close()
-        print('Test data generated.')
+
+    print('Test data generated: %d uploads put, %d keys inserted, %d duplicates skipped in %d clusters.' % (
+        upload_count, inserted_count, generated_count - inserted_count, len(cluster_ids)))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,124 @@
+import os
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.pool import NullPool, QueuePool, SingletonThreadPool, StaticPool
+
+POOL_CLASSES = {
+    'null': NullPool,
+    'queue': QueuePool,
+    'singleton_thread': SingletonThreadPool,
+    'static': StaticPool,
+}
+
+# Values accepted by the PRAGMAs that take a keyword. The others take an integer.
+SQLITE_JOURNAL_MODES = ['DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF']
+SQLITE_SYNCHRONOUS_LEVELS = ['OFF', 'NORMAL', 'FULL', 'EXTRA']
+
+engine = None
+
+# Bound to the engine by init_engine(). One session per thread, removed at the end of each request.
+Session = scoped_session(
+    sessionmaker(
+        autocommit=False,
+        autoflush=False
+    )
+)
+
+
+def _sqlite_pragma_statements(sqlite_pragmas):
+    statements = []
+    for name, value in sqlite_pragmas.items():
+        # None leaves SQLite's default.
+        if value is None:
+            continue
+        if name == 'journal_mode':
+            assert value.upper() in SQLITE_JOURNAL_MODES, 'Unknown journal mode %s.' % value
+            value = value.upper()
+        elif name == 'synchronous':
+            assert value.upper() in SQLITE_SYNCHRONOUS_LEVELS, 'Unknown synchronous level %s.' % value
+            value = value.upper()
+        else:
+            value = int(value)
+        statements.append('PRAGMA %s = %s' % (name, value))
+    return statements
+
+
+def _set_sqlite_pragmas(engine, sqlite_pragmas):
+    statements = _sqlite_pragma_statements(sqlite_pragmas)
+    if len(statements) == 0:
+        return
+
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for statement in statements:
+                cursor.execute(statement)
+        finally:
+            cursor.close()
+
+
+def init_engine(db_uri, echo=False, pool_class=None, pool_size=None, sqlite_pragmas=None):
+    global engine
+
+    if engine is not None:
+        return engine
+
+    options = {}
+    if pool_class is not None:
+        assert pool_class in POOL_CLASSES, 'Unknown pool class %s.' % pool_class
+        options['poolclass'] = POOL_CLASSES[pool_class]
+    if pool_size is not None:
+        options['pool_size'] = pool_size
+
+    engine = create_engine(
+        db_uri,
+        encoding="utf-8",
+        echo=echo,
+        **options)
+
+    # Applied to every new connection, since most of them are not stored in the database file.
+    if sqlite_pragmas is not None and engine.dialect.name == 'sqlite':
+        _set_sqlite_pragmas(engine, sqlite_pragmas)
+
+    Session.configure(bind=engine)
+
+    return engine
+
+
+def init_engine_from_configuration(config):
+    return init_engine(
+        config.db_uri,
+        echo=config.db_echo,
+        pool_class=config.db_pool_class,
+        pool_size=config.db_pool_size,
+        # busy_timeout first, so that switching the journal mode waits for other connections too.
+        sqlite_pragmas={
+            'busy_timeout': config.db_busy_timeout_in_ms,
+            'journal_mode': config.db_journal_mode,
+            'synchronous': config.db_synchronous,
+            'mmap_size': config.db_mmap_size,
+            'cache_size': config.db_cache_size,
+        }
+    )
+
+
+def _dispose_after_fork():
+    if engine is None:
+        return
+
+    # Drop the connections inherited from the parent without closing them under its feet.
+    try:
+        engine.dispose(close=False)
+    except TypeError:
+        # SQLAlchemy < 1.4.33
+        engine.dispose()
+
+
+try:
+    from uwsgidecorators import postfork
+
+    postfork(_dispose_after_fork)
+except ImportError:
+    os.register_at_fork(after_in_child=_dispose_after_fork)
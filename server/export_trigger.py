@@ -0,0 +1,83 @@
+import os
+import select
+import socket
+import time
+
+TRIGGER_MESSAGE = b'\x01'
+
+
+def notify(socket_path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.setblocking(False)
+        sock.sendto(TRIGGER_MESSAGE, socket_path)
+    except OSError:
+        # The exporter is not running or is already flooded with triggers. Either way it will catch up by polling.
+        pass
+    finally:
+        sock.close()
+
+
+class ExportTrigger:
+    def __init__(self, socket_path=None):
+        self.socket_path = socket_path
+        self._socket = None
+
+        # Written by wakeup(), e.g. from a signal handler, to interrupt wait().
+        self._wakeup_read_fd, self._wakeup_write_fd = os.pipe()
+        os.set_blocking(self._wakeup_write_fd, False)
+
+        if socket_path is not None:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._socket.bind(socket_path)
+            self._socket.setblocking(False)
+            # Allow web workers running as another user to notify.
+            os.chmod(socket_path, 0o666)
+
+    def _readable(self, timeout):
+        readables = [self._wakeup_read_fd]
+        if self._socket is not None:
+            readables.append(self._socket)
+        readable, _, _ = select.select(readables, [], [], timeout)
+        return readable
+
+    def _drain(self):
+        while True:
+            try:
+                self._socket.recv(64)
+            except BlockingIOError:
+                return
+
+    def wait(self, timeout):
+        """Returns True when notified, False on timeout or wakeup()."""
+        readable = self._readable(timeout)
+        if self._wakeup_read_fd in readable or self._socket not in readable:
+            return False
+
+        self._drain()
+        return True
+
+    def coalesce(self, window):
+        """Absorbs the notifications arriving within window seconds after the first one."""
+        deadline = time.monotonic() + window
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            if not self.wait(remaining) and self._wakeup_read_fd in self._readable(0):
+                return
+
+    def wakeup(self):
+        try:
+            os.write(self._wakeup_write_fd, b'\x00')
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        if self._socket is not None:
+            self._socket.close()
+            os.remove(self.socket_path)
+        os.close(self._wakeup_read_fd)
+        os.close(self._wakeup_write_fd)
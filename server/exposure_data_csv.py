@@ -0,0 +1,154 @@
+import csv
+import fcntl
+import io
+import os
+
+from exposure_data_store import get_exposure_data_dir
+
+EXPOSURE_WINDOWS_CSV_HEADER = [
+    "CalibrationConfidence", "DateMillisSinceEpoch", "WindowNumber", "Infectiousness", "ReportType",
+    "MinAttenuationDb", "SecondsSinceLastScan", "TypicalAttenuationDb"
+]
+
+DAILY_SUMMARIES_CSV_HEADER = ["DateMillisSinceEpoch", "Type", "MaximumScore", "ScoreSum", "WeightedDurationSum"]
+
+DAILY_SUMMARY_TYPES = [
+    "DaySummary", "ConfirmedClinicalDiagnosisSummary", "ConfirmedTestSummary", "RecursiveSummary",
+    "SelfReportedSummary"
+]
+
+# Rows are encoded and sent in chunks of about this size.
+CSV_CHUNK_SIZE = 64 * 1024
+
+# Cluster-wide datasets prefix every row with the upload it came from.
+DATASET_HEADER_PREFIX = ["Identifier", "Created"]
+
+
+def exposure_windows_csv_rows(exposure_windows):
+    for window_number, ew in enumerate(exposure_windows):
+        calibrationConfidence = ew["CalibrationConfidence"]
+        dateMillisSinceEpoch = ew["DateMillisSinceEpoch"]
+        infectiousness = ew["Infectiousness"]
+        reportType = ew["ReportType"]
+        for si in ew["ScanInstances"]:
+            yield [
+                calibrationConfidence, dateMillisSinceEpoch, window_number, infectiousness, reportType,
+                si["MinAttenuationDb"], si["SecondsSinceLastScan"], si["TypicalAttenuationDb"],
+            ]
+
+
+def daily_summaries_csv_rows(daily_summaries):
+    for ds in daily_summaries:
+        dateMillisSinceEpoch = ds["DateMillisSinceEpoch"]
+        for type in DAILY_SUMMARY_TYPES:
+            summary = ds[type]
+            if summary is not None:
+                yield [
+                    dateMillisSinceEpoch,
+                    type,
+                    summary["MaximumScore"],
+                    summary["ScoreSum"],
+                    summary["WeightedDurationSum"]
+                ]
+
+
+# file name -> (key of the exposure data, header, row generator)
+CSV_TYPES = {
+    'exposure_windows.csv': ('exposure_windows', EXPOSURE_WINDOWS_CSV_HEADER, exposure_windows_csv_rows),
+    'daily_summaries.csv': ('daily_summaries', DAILY_SUMMARIES_CSV_HEADER, daily_summaries_csv_rows),
+}
+
+
+def encode_csv(header, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() >= CSV_CHUNK_SIZE:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+
+    yield buffer.getvalue().encode('utf-8')
+
+
+def get_dataset_path(base_path, cluster_id, name):
+    return os.path.join(get_exposure_data_dir(base_path, cluster_id), name)
+
+
+def encode_dataset_rows(identifier, created_timestamp, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([identifier, int(created_timestamp)] + row)
+    return buffer.getvalue().encode('utf-8')
+
+
+def append_datasets(base_path, cluster_id, identifier, created_timestamp, json_obj):
+    """Appends the rows of one upload to every cluster-wide dataset it has data for."""
+    for name, (key, header, rows) in CSV_TYPES.items():
+        if json_obj.get(key) is None:
+            continue
+
+        data = encode_dataset_rows(identifier, created_timestamp, rows(json_obj[key]))
+        if len(data) == 0:
+            continue
+
+        with open(get_dataset_path(base_path, cluster_id, name), mode='ab') as fp:
+            # Held until the file is closed. Readers take a shared lock to find a size that ends on a row.
+            fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+            if os.fstat(fp.fileno()).st_size == 0:
+                fp.write(b''.join(encode_csv(DATASET_HEADER_PREFIX + header, [])))
+            fp.write(data)
+            fp.flush()
+
+
+def _read_rows_since(fp, size, since):
+    # Created is the second column and never quoted, so rows are filtered without parsing them as CSV.
+    buffer = []
+    buffer_size = 0
+    while fp.tell() < size:
+        line = fp.readline()
+        if int(line.split(b',', 2)[1]) <= since:
+            continue
+        buffer.append(line)
+        buffer_size += len(line)
+        if buffer_size >= CSV_CHUNK_SIZE:
+            yield b''.join(buffer)
+            buffer = []
+            buffer_size = 0
+
+    if buffer_size > 0:
+        yield b''.join(buffer)
+
+
+def read_dataset(base_path, cluster_id, name, since=None):
+    """Yields the dataset in chunks, with only the rows of uploads created after since when given."""
+    _, header, _ = CSV_TYPES[name]
+    dataset_path = get_dataset_path(base_path, cluster_id, name)
+
+    if not os.path.exists(dataset_path):
+        yield from encode_csv(DATASET_HEADER_PREFIX + header, [])
+        return
+
+    with open(dataset_path, mode='rb') as fp:
+        fcntl.flock(fp.fileno(), fcntl.LOCK_SH)
+        size = os.fstat(fp.fileno()).st_size
+        fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+
+        # Created by a writer that has not written the header yet.
+        if size == 0:
+            yield from encode_csv(DATASET_HEADER_PREFIX + header, [])
+            return
+
+        # Rows appended after this point are left to the next request.
+        yield fp.readline()
+
+        if since is not None:
+            yield from _read_rows_since(fp, size, since)
+            return
+
+        while fp.tell() < size:
+            yield fp.read(min(CSV_CHUNK_SIZE, size - fp.tell()))
@@ -0,0 +1,75 @@
+import os
+import re
+
+EXPOSURE_DATA_DIR = 'exposure_data'
+
+SUFFIX_JSON = '.json'
+SUFFIX_JSON_GZIP = '.json.gz'
+SUFFIX_EXPOSURE_WINDOWS_CSV = '-exposure_windows.csv'
+SUFFIX_DAILY_SUMMARIES_CSV = '-daily_summaries.csv'
+
+SUFFIXES = [SUFFIX_JSON_GZIP, SUFFIX_JSON, SUFFIX_EXPOSURE_WINDOWS_CSV, SUFFIX_DAILY_SUMMARIES_CSV]
+
+# Files of an upload live in <base_path>/<cluster_id>/exposure_data/<identifier[0:2]>/<identifier[2:4]>/
+SHARD_LEVELS = 2
+SHARD_WIDTH = 2
+
+IDENTIFIER_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+
+def is_identifier(identifier):
+    return IDENTIFIER_PATTERN.match(identifier) is not None
+
+
+def split_file_name(file_name):
+    """Returns (identifier, suffix), or (None, None) when file_name is not an exposure data file."""
+    for suffix in SUFFIXES:
+        if file_name.endswith(suffix):
+            identifier = file_name[:-len(suffix)]
+            if is_identifier(identifier):
+                return identifier, suffix
+    return None, None
+
+
+def get_exposure_data_dir(base_path, cluster_id):
+    return os.path.join(base_path, str(cluster_id), EXPOSURE_DATA_DIR)
+
+
+def get_shard_dir(base_path, cluster_id, identifier):
+    shards = [identifier[level * SHARD_WIDTH:(level + 1) * SHARD_WIDTH] for level in range(SHARD_LEVELS)]
+    return os.path.join(get_exposure_data_dir(base_path, cluster_id), *shards)
+
+
+def get_file_path(base_path, cluster_id, identifier, suffix):
+    return os.path.join(get_shard_dir(base_path, cluster_id, identifier), identifier + suffix)
+
+
+def get_legacy_file_path(base_path, cluster_id, identifier, suffix):
+    return os.path.join(get_exposure_data_dir(base_path, cluster_id), identifier + suffix)
+
+
+def resolve_file_path(base_path, cluster_id, identifier, suffix):
+    """Falls back to the flat layout for trees that have not been migrated yet."""
+    file_path = get_file_path(base_path, cluster_id, identifier, suffix)
+    if os.path.exists(file_path):
+        return file_path
+
+    legacy_file_path = get_legacy_file_path(base_path, cluster_id, identifier, suffix)
+    if os.path.exists(legacy_file_path):
+        return legacy_file_path
+
+    return file_path
+
+
+def iter_stored_files(base_path, cluster_id):
+    """Yields (identifier, suffix, path) of every exposure data file of the cluster, in either layout."""
+    exposure_data_dir = get_exposure_data_dir(base_path, cluster_id)
+
+    for dir_path, _, file_names in os.walk(exposure_data_dir):
+        depth = len(os.path.relpath(dir_path, exposure_data_dir).split(os.sep)) if dir_path != exposure_data_dir else 0
+        if depth not in (0, SHARD_LEVELS):
+            continue
+        for file_name in file_names:
+            identifier, suffix = split_file_name(file_name)
+            if identifier is not None:
+                yield identifier, suffix, os.path.join(dir_path, file_name)
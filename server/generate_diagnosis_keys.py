@@ -1,20 +1,32 @@
 import base64
-import hashlib
+import io
 import json
+import logging
 import os
-import sys
-import tempfile
+import signal
+import time
+import uuid
 import zipfile
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import temporary_exposure_key_export_pb2 as tek
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, scoped_session
+from absl import app
+from absl import flags
+from sqlalchemy import func
 
-from ecdsa import SigningKey
-
-from scheme import Base, DiagnosisKey
+from common import publish_file
+from ingest_journal import replay_orphaned_journals
+from manifest import get_diagnosis_keys_dir, publish_manifest
+from scheme import Base, DiagnosisKey, DiagnosisKeyUpload, ExportWatermark, ExportBatch
 from configuration import Configuration
+from database import Session, init_engine_from_configuration
+from export_trigger import ExportTrigger
+from signer import create_signer
+
+FLAGS = flags.FLAGS
+flags.DEFINE_bool("daemon", False, "Keep running and export whenever new diagnosis-keys arrive")
 
 HEADER = "EK Export v1    "
 HEADER_BYTES = HEADER.encode(encoding='utf-8')
@@ -25,7 +37,21 @@ SIGNATURE_ALGORITHM = '1.2.840.10045.4.3.2'
 FILENAME_BIN = 'export.bin'
 FILENAME_SIG = 'export.sig'
 
-DIAGNOSIS_KEYS_DIR = 'diagnosis_keys'
+# Plain rows instead of ORM objects, so that they can be handed to worker processes.
+ExportKey = namedtuple('ExportKey', [
+    'key', 'transmissionRisk', 'rollingStartNumber', 'rollingPeriod', 'reportType', 'daysSinceOnsetOfSymptoms',
+    'createdAt'
+])
+
+# Only the range of uploads is handed to workers. Each worker streams the keys itself.
+ExportJob = namedtuple('ExportJob', [
+    'cluster_id', 'from_upload_id', 'to_upload_id', 'output_dir'
+])
+
+# Loaded once per process by _init_worker().
+_signer = None
+
+logger = logging.getLogger('generate_diagnosis_keys')
 
 
 def _setup_signature_info(signature_info, verification_key_id):
@@ -44,15 +70,10 @@ def _setup_key(diagnosis_key, key):
     key.report_type = diagnosis_key.reportType
     key.days_since_onset_of_symptoms = diagnosis_key.daysSinceOnsetOfSymptoms
 
-    print(key.key_data.hex())
-    print(key.days_since_onset_of_symptoms)
-
     return key
 
 
-def _export_generate(cluster_id, verification_id, diagnosis_keys, output_dir, batch_num=1, batch_size=1):
-    output_path = os.path.join(output_dir, FILENAME_BIN)
-
+def _export_generate(cluster_id, verification_id, diagnosis_keys, batch_num=1, batch_size=1):
     tekObj = tek.TemporaryExposureKeyExport()
     tekObj.start_timestamp = min(map(lambda dk: dk.createdAt, diagnosis_keys))
     tekObj.end_timestamp = max(map(lambda dk: dk.createdAt, diagnosis_keys))
@@ -60,22 +81,20 @@ def _export_generate(cluster_id, verification_id, diagnosis_keys, output_dir, ba
     tekObj.batch_num = batch_num
     tekObj.batch_size = batch_size
 
+    is_debug = logger.isEnabledFor(logging.DEBUG)
     for dk in diagnosis_keys:
-        _ = _setup_key(dk, tekObj.keys.add())
+        key = _setup_key(dk, tekObj.keys.add())
+        if is_debug:
+            logger.debug('key: %s, days_since_onset_of_symptoms: %d',
+                         key.key_data.hex(), key.days_since_onset_of_symptoms)
 
     signature_info = tekObj.signature_infos.add()
     _setup_signature_info(signature_info, verification_id)
 
-    with open(output_path, 'wb') as fp:
-        fp.write(HEADER_BYTES)
-        fp.write(tekObj.SerializeToString())
-
-    return output_path
+    return HEADER_BYTES + tekObj.SerializeToString()
 
 
-def _export_tek_signs(export_bin_path, verification_id, signing_key, output_dir, batch_num=1, batch_size=1):
-    output_path = os.path.join(output_dir, FILENAME_SIG)
-
+def _export_tek_signs(export_bin, verification_id, signer, batch_num=1, batch_size=1):
     tekSignList = tek.TEKSignatureList()
 
     tekSignature = tekSignList.signatures.add()
@@ -83,92 +102,371 @@ def _export_tek_signs(export_bin_path, verification_id, signing_key, output_dir,
     tekSignature.batch_num = batch_num
     tekSignature.batch_size = batch_size
 
-    with open(export_bin_path, mode='rb') as fp:
-        bytes = fp.read()
-        signature = signing_key.sign(bytes)
-        tekSignature.signature = signature
-        print(signature.hex())
+    signature = signer.sign(export_bin)
+    tekSignature.signature = signature
+    logger.debug('signature: %s', signature.hex())
 
-    with open(output_path, 'wb') as fp:
-        fp.write(tekSignList.SerializeToString())
+    return tekSignList.SerializeToString()
 
-    return output_path
 
+def _export_file_name(batch_id, batch_num, batch_size):
+    return 'diagnosis_keys-%s-%d-of-%d.zip' % (batch_id, batch_num, batch_size)
 
-def _compress_zip(export_bin_path, export_sig_path, output_dir):
-    fd, output_path = tempfile.mkstemp(prefix='diagnosis_keys-', suffix='.zip', dir=output_dir)
-    os.close(fd)
 
-    with zipfile.ZipFile(output_path, mode='w', compression=zipfile.ZIP_DEFLATED) as zip:
-        zip.write(export_bin_path, arcname=FILENAME_BIN)
-        zip.write(export_sig_path, arcname=FILENAME_SIG)
+def _compress_zip(export_bin, export_sig):
+    buffer = io.BytesIO()
 
-    return output_path
+    with zipfile.ZipFile(buffer, mode='w', compression=zipfile.ZIP_DEFLATED) as zip:
+        zip.writestr(FILENAME_BIN, export_bin)
+        zip.writestr(FILENAME_SIG, export_sig)
 
+    return buffer.getvalue()
 
-def export_diagnosis_keys(config):
-    assert os.path.exists(config.base_path), '%s not exists' % config.base_path
 
-    fp = open(config.signing_key_path)
-    signing_key = SigningKey.from_pem(fp.read(), hashlib.sha256)
-    fp.close()
+def _find_updated_clusters(session):
+    watermark = func.coalesce(ExportWatermark.upload_id, 0)
 
-    engine = create_engine(
-        config.db_uri,
-        encoding="utf-8",
-        echo=True)
+    rows = session.query(
+        DiagnosisKeyUpload.cluster_id,
+        func.max(watermark),
+        func.max(DiagnosisKeyUpload.id)
+    ) \
+        .outerjoin(ExportWatermark, ExportWatermark.cluster_id == DiagnosisKeyUpload.cluster_id) \
+        .filter(DiagnosisKeyUpload.id > watermark) \
+        .group_by(DiagnosisKeyUpload.cluster_id) \
+        .all()
 
-    Base.metadata.create_all(bind=engine)
+    return list(map(tuple, rows))
+
+
+def _filter_job_keys(query, job):
+    return query \
+        .filter(DiagnosisKey.cluster_id == job.cluster_id) \
+        .filter(DiagnosisKey.upload_id > job.from_upload_id) \
+        .filter(DiagnosisKey.upload_id <= job.to_upload_id)
+
+
+def _count_keys(session, job):
+    return _filter_job_keys(session.query(func.count(DiagnosisKey.primary_key)), job).scalar()
+
+
+def _iter_key_chunks(session, job, max_keys_per_file):
+    """Yields the keys of the job in lists of up to max_keys_per_file, one file's worth at a time."""
+    query = _filter_job_keys(session.query(*map(lambda field: getattr(DiagnosisKey, field), ExportKey._fields)), job) \
+        .order_by(DiagnosisKey.upload_id, DiagnosisKey.primary_key)
+
+    rows = iter(query.yield_per(max_keys_per_file))
+    try:
+        key_chunk = []
+        for row in rows:
+            key_chunk.append(ExportKey(*row))
+            if len(key_chunk) == max_keys_per_file:
+                yield key_chunk
+                key_chunk = []
+
+        if len(key_chunk) > 0:
+            yield key_chunk
+    finally:
+        # Releases the cursor when the consumer stops early.
+        rows.close()
+
+
+def _init_worker(signing_key_path, signing_backend):
+    global _signer
+
+    _signer = create_signer(signing_key_path, signing_backend)
+
+
+def _init_pool_worker(signing_key_path, signing_backend):
+    # The parent process coordinates shutdown and waits for the running exports.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    _init_worker(signing_key_path, signing_backend)
+
+
+def _export_cluster(config, job):
+    os.makedirs(job.output_dir, exist_ok=True)
+
+    verification_id = config.region
+
+    batch_id = uuid.uuid4().hex[:8]
+
+    metrics = {
+        'query_sec': 0.0,
+        'serialize_sec': 0.0,
+        'sign_sec': 0.0,
+        'zip_sec': 0.0,
+        'publish_sec': 0.0,
+        'output_bytes': 0,
+    }
+
+    # A session of this worker. Uploads in the range never change, so the count matches the stream.
+    session = Session()
+    key_chunks = None
+    try:
+        started = time.perf_counter()
+        key_count = _count_keys(session, job)
+        metrics['query_sec'] += time.perf_counter() - started
+
+        # Every file carries batch_size, so it is known before the first one is written.
+        batch_size = -(-key_count // config.export_max_keys_per_file)
+
+        exported_files = []
+        key_chunks = _iter_key_chunks(session, job, config.export_max_keys_per_file)
+        started = time.perf_counter()
+        for batch_num, diagnosis_keys in enumerate(key_chunks, start=1):
+            fetched = time.perf_counter()
+            export_bin = _export_generate(job.cluster_id, verification_id, diagnosis_keys, batch_num, batch_size)
+            serialized = time.perf_counter()
+            export_sig = _export_tek_signs(export_bin, verification_id, _signer, batch_num, batch_size)
+            signed = time.perf_counter()
+            export_zip = _compress_zip(export_bin, export_sig)
+            zipped = time.perf_counter()
+            export_zip_path = publish_file(export_zip, job.output_dir,
+                                           _export_file_name(batch_id, batch_num, batch_size))
+            published = time.perf_counter()
+
+            metrics['query_sec'] += fetched - started
+            metrics['serialize_sec'] += serialized - fetched
+            metrics['sign_sec'] += signed - serialized
+            metrics['zip_sec'] += zipped - signed
+            metrics['publish_sec'] += published - zipped
+            metrics['output_bytes'] += len(export_zip)
+
+            exported_files.append((export_zip_path, len(diagnosis_keys)))
+            started = time.perf_counter()
+
+        assert len(exported_files) == batch_size, \
+            'Cluster %s: %d files exported instead of %d.' % (job.cluster_id, len(exported_files), batch_size)
+    finally:
+        # The cursor of the stream is closed before the session, also when an export fails midway.
+        if key_chunks is not None:
+            key_chunks.close()
+        session.close()
+
+    metrics['key_count'] = key_count
+    metrics['file_count'] = batch_size
+    # Resolved in the worker, where 'auto' has picked a backend.
+    metrics['signing_backend'] = _signer.name
+
+    # All files of the batch appear in list.json at once.
+    if len(exported_files) > 0:
+        publish_manifest(config, job.cluster_id, list(map(lambda exported_file: exported_file[0], exported_files)))
 
-    session = scoped_session(
-        sessionmaker(
-            autocommit=False,
-            autoflush=False,
-            bind=engine
-        )
+    return exported_files, metrics
+
+
+def _create_executor(config):
+    if config.export_workers <= 1:
+        return None
+
+    return ProcessPoolExecutor(
+        max_workers=config.export_workers,
+        initializer=_init_pool_worker,
+        initargs=(config.signing_key_path, config.signing_backend)
     )
 
+
+def _run_export_jobs(config, jobs, executor):
+    if executor is None:
+        if _signer is None:
+            _init_worker(config.signing_key_path, config.signing_backend)
+        for job in jobs:
+            try:
+                yield job, _export_cluster(config, job), None
+            except Exception as e:
+                yield job, None, e
+        return
+
+    futures = {
+        executor.submit(_export_cluster, config, job): job
+        for job in jobs
+    }
+    for future in as_completed(futures):
+        job = futures[future]
+        try:
+            yield job, future.result(), None
+        except Exception as e:
+            yield job, None, e
+
+
+def _emit_metrics(config, run_metrics):
+    json_str = json.dumps(run_metrics, separators=(',', ':'))
+
+    logger.info('export_metrics: %s', json_str)
+
+    if config.export_metrics_path is not None:
+        with open(config.export_metrics_path, mode='a') as fp:
+            fp.write(json_str + '\n')
+
+
+def _round_durations(metrics):
+    return {
+        name: round(value, 6) if name.endswith('_sec') else value
+        for name, value in metrics.items()
+    }
+
+
+def _record_export(session, job, exported_files):
+    batch_size = len(exported_files)
+    for batch_num, (export_zip_path, key_count) in enumerate(exported_files, start=1):
+        session.add(ExportBatch(
+            cluster_id=job.cluster_id,
+            from_upload_id=job.from_upload_id,
+            to_upload_id=job.to_upload_id,
+            batch_num=batch_num,
+            batch_size=batch_size,
+            key_count=key_count,
+            file_name=os.path.basename(export_zip_path),
+            createdAt=int(time.time())
+        ))
+
+    session.merge(ExportWatermark(cluster_id=job.cluster_id, upload_id=job.to_upload_id))
+    session.commit()
+
+
+def _replay_ingest_journals(config):
+    if config.ingest_journal_dir is not None and os.path.exists(config.ingest_journal_dir):
+        # Keys accepted by web_api processes that have ended before flushing them.
+        replay_orphaned_journals(config.ingest_journal_dir, config.ingest_flush_max_keys)
+
+
+def export_diagnosis_keys(config, executor=None):
+    """Returns True when every updated cluster has been exported."""
+    assert os.path.exists(config.base_path), '%s not exists' % config.base_path
+
+    engine = init_engine_from_configuration(config)
+
+    Base.metadata.create_all(bind=engine)
+
+    _replay_ingest_journals(config)
+
+    if executor is None and config.export_workers > 1:
+        with _create_executor(config) as executor:
+            return _export_diagnosis_keys(config, executor)
+
+    return _export_diagnosis_keys(config, executor)
+
+
+def _export_diagnosis_keys(config, executor):
+    session = Session()
+
+    run_started = time.perf_counter()
+    run_metrics = {
+        'started_at': int(time.time()),
+        'workers': config.export_workers,
+        'signing_backend': config.signing_backend,
+        'clusters': [],
+    }
+    cluster_metrics = {}
+
     try:
-        cluster_objs = session.query(DiagnosisKey.cluster_id, DiagnosisKey.exported) \
-            .filter(DiagnosisKey.exported == False) \
-            .distinct() \
-            .all()
+        updated_clusters = _find_updated_clusters(session)
+
+        if len(updated_clusters) == 0:
+            logger.info('No updated-cluster found.')
+            return True
+
+        logger.info('%d updated-cluster found.', len(updated_clusters))
+
+        jobs = []
+        for cluster_id, from_upload_id, to_upload_id in updated_clusters:
+            output_dir = get_diagnosis_keys_dir(config.base_path, cluster_id)
+            cluster_metrics[cluster_id] = {'cluster_id': cluster_id}
+            jobs.append(ExportJob(cluster_id, from_upload_id, to_upload_id, output_dir))
 
-        if len(cluster_objs) == 0:
-            print('No updated-cluster found.')
-            return
+        # Release the read transaction while the workers export.
+        session.rollback()
 
-        print('%d updated-cluster found.' % len(cluster_objs))
+        succeeded = True
+        for job, result, error in _run_export_jobs(config, jobs, executor):
+            metrics = cluster_metrics[job.cluster_id]
+            run_metrics['clusters'].append(metrics)
 
-        for obj in cluster_objs:
-            cluster_id = obj.cluster_id
-            output_dir = os.path.join(config.base_path, str(cluster_id), DIAGNOSIS_KEYS_DIR)
-            os.makedirs(output_dir, exist_ok=True)
+            if error is not None:
+                logger.error('export_failed: cluster %s: %s', job.cluster_id, repr(error))
+                metrics['error'] = repr(error)
+                succeeded = False
+                continue
 
-            diagnosis_keys = session.query(DiagnosisKey) \
-                .filter(DiagnosisKey.cluster_id == cluster_id) \
-                .filter(DiagnosisKey.exported == False) \
-                .all()
+            exported_files, export_metrics = result
+            # Every worker resolves the same backend from the same configuration.
+            run_metrics['signing_backend'] = export_metrics.pop('signing_backend')
+            metrics.update(export_metrics)
 
-            print('%d new diagnosis-keys have been found.' % len(diagnosis_keys))
+            logger.info('Cluster %s: %d new diagnosis-keys have been found.', job.cluster_id, metrics['key_count'])
 
-            export_bin_path = _export_generate(cluster_id, config.region, diagnosis_keys, output_dir)
-            export_sig_path = _export_tek_signs(export_bin_path, config.region, signing_key, output_dir)
-            export_zip_path = _compress_zip(export_bin_path, export_sig_path, output_dir)
+            commit_started = time.perf_counter()
+            _record_export(session, job, exported_files)
+            metrics['commit_sec'] = time.perf_counter() - commit_started
 
-            os.remove(export_bin_path)
-            os.remove(export_sig_path)
+            for export_zip_path, _ in exported_files:
+                logger.info('export_completed: %s', export_zip_path)
 
-            for diagnosis_key in diagnosis_keys:
-                diagnosis_key.exported = True
-            session.commit()
+        return succeeded
 
-            print("export_completed: %s" % export_zip_path)
+    finally:
+        session.close()
+
+        if len(run_metrics['clusters']) > 0:
+            run_metrics['clusters'] = list(map(_round_durations, run_metrics['clusters']))
+            run_metrics['key_count'] = sum(map(lambda metrics: metrics.get('key_count', 0), run_metrics['clusters']))
+            run_metrics['output_bytes'] = sum(
+                map(lambda metrics: metrics.get('output_bytes', 0), run_metrics['clusters']))
+            run_metrics['elapsed_sec'] = round(time.perf_counter() - run_started, 6)
+            _emit_metrics(config, run_metrics)
 
+
+def _latest_upload_id(session):
+    try:
+        return session.query(func.max(DiagnosisKeyUpload.id)).scalar()
     finally:
         session.close()
 
 
+def run_daemon(config):
+    engine = init_engine_from_configuration(config)
+
+    Base.metadata.create_all(bind=engine)
+
+    trigger = ExportTrigger(config.export_trigger_socket)
+    executor = _create_executor(config)
+    if executor is None:
+        _init_worker(config.signing_key_path, config.signing_backend)
+
+    stopping = []
+
+    def _stop(signum, frame):
+        logger.info('Signal %d received. Shutting down after the current export.', signum)
+        stopping.append(signum)
+        trigger.wakeup()
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+
+    exported_upload_id = None
+
+    try:
+        while len(stopping) == 0:
+            # Before checking for new uploads, so that replayed keys are exported by this run.
+            _replay_ingest_journals(config)
+
+            latest_upload_id = _latest_upload_id(Session())
+            if latest_upload_id is not None and latest_upload_id != exported_upload_id:
+                if export_diagnosis_keys(config, executor):
+                    exported_upload_id = latest_upload_id
+
+            if trigger.wait(config.export_poll_interval_in_sec):
+                # Let a burst of uploads land before exporting them together.
+                trigger.coalesce(config.export_debounce_in_sec)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        trigger.close()
+        logger.info('Exporter stopped.')
+
+
 def main(argv):
     assert 'CONFIG_PATH' in os.environ, 'Env "CONFIG_PATH" must be set.'
 
@@ -180,8 +478,13 @@ def main(argv):
     with open(config_path, mode='r') as fp:
         config = Configuration(json.load(fp))
 
-    export_diagnosis_keys(config)
+    logging.getLogger().setLevel(config.log_level)
+
+    if FLAGS.daemon:
+        run_daemon(config)
+    else:
+        export_diagnosis_keys(config)
 
 
 if __name__ == '__main__':
-    main(sys.argv)
+    app.run(main)
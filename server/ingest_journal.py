@@ -0,0 +1,297 @@
+import atexit
+import fcntl
+import glob
+import json
+import logging
+import os
+import tempfile
+import threading
+
+from common import filter_new_diagnosis_keys, insert_diagnosis_keys, publish_file
+from database import Session
+from export_trigger import notify
+from scheme import DiagnosisKey
+
+JOURNAL_FILE_PATTERN = 'journal-*.log'
+CHECKPOINT_SUFFIX = '.checkpoint'
+
+# A journal that has been flushed completely is replaced by a new one once it grows beyond this.
+ROTATE_SIZE = 64 * 1024 * 1024
+
+logger = logging.getLogger('ingest_journal')
+
+
+def _get_checkpoint_path(journal_path):
+    return journal_path + CHECKPOINT_SUFFIX
+
+
+def _fsync_dir(dir_path):
+    fd = os.open(dir_path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _read_checkpoint(journal_path):
+    checkpoint_path = _get_checkpoint_path(journal_path)
+    if not os.path.exists(checkpoint_path):
+        return 0
+    with open(checkpoint_path, mode='r') as fp:
+        return int(fp.read())
+
+
+def _write_checkpoint(journal_path, offset):
+    publish_file(str(offset).encode('utf-8'), os.path.dirname(journal_path),
+                 os.path.basename(_get_checkpoint_path(journal_path)))
+
+
+def _read_records(journal_path, offset, end=None):
+    """Yields (record, offset after it) of the complete records from offset on."""
+    with open(journal_path, mode='rb') as fp:
+        fp.seek(offset)
+        while end is None or offset < end:
+            line = fp.readline()
+            # A torn last line was never acknowledged.
+            if not line.endswith(b'\n'):
+                return
+            offset += len(line)
+            yield json.loads(line), offset
+
+
+def _flush_records(session, records):
+    """Inserts the keys of records, grouped into one upload per cluster, and returns the inserted keys."""
+    keys_by_cluster = {}
+    for record in records:
+        keys_by_cluster.setdefault(record['cluster_id'], []).extend(
+            DiagnosisKey(**row) for row in record['keys'])
+
+    inserted_keys = []
+    for cluster_id, diagnosis_keys in keys_by_cluster.items():
+        # Deduplicated again: another process may have accepted the same key, or a replay may repeat a flush.
+        inserted_keys.extend(insert_diagnosis_keys(session, cluster_id, diagnosis_keys))
+    session.commit()
+
+    return inserted_keys
+
+
+def _drain(journal_path, offset, end, max_keys):
+    """Flushes the records between offset and end in transactions of about max_keys and returns the new offset."""
+    records = []
+    key_count = 0
+    record_end = offset
+    for record, record_end in _read_records(journal_path, offset, end):
+        records.append(record)
+        key_count += len(record['keys'])
+        if key_count >= max_keys:
+            break
+
+    if len(records) == 0:
+        return offset, []
+
+    session = Session()
+    try:
+        inserted_keys = _flush_records(session, records)
+    finally:
+        session.close()
+
+    logger.debug('%d of %d keys in %s have been inserted.', len(inserted_keys), key_count, journal_path)
+
+    # A crash before the checkpoint replays the records, which the deduplication makes harmless.
+    _write_checkpoint(journal_path, record_end)
+
+    return record_end, records
+
+
+def replay_orphaned_journals(journal_dir, max_keys):
+    """Flushes the journals of processes that ended before flushing them, and removes them."""
+    replayed = False
+    for journal_path in sorted(glob.glob(os.path.join(journal_dir, JOURNAL_FILE_PATTERN))):
+        with open(journal_path, mode='rb') as fp:
+            try:
+                # Every live journal is locked by the process that writes it.
+                fcntl.flock(fp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+
+            if not os.path.exists(journal_path):
+                # Removed by another replayer while this one waited for the lock.
+                continue
+
+            offset = _read_checkpoint(journal_path)
+            while True:
+                offset, records = _drain(journal_path, offset, None, max_keys)
+                if len(records) == 0:
+                    break
+                replayed = True
+
+            logger.info('Journal %s has been replayed.', journal_path)
+            os.remove(journal_path)
+            if os.path.exists(_get_checkpoint_path(journal_path)):
+                os.remove(_get_checkpoint_path(journal_path))
+
+    return replayed
+
+
+class IngestJournal:
+    """Accepts diagnosis-keys into a local journal and flushes them into the database in the background.
+
+    Requests are acknowledged once their record is fsynced. Records appended while another request fsyncs
+    are made durable together by the next fsync.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.journal_dir = config.ingest_journal_dir
+        os.makedirs(self.journal_dir, exist_ok=True)
+
+        # Guards the journal file, the offsets and the pending keys.
+        self._lock = threading.Lock()
+        # Serializes fsync, so that requests waiting for it share the next one.
+        self._sync_lock = threading.Lock()
+        self._flush_event = threading.Event()
+        self._closed = threading.Event()
+
+        # Keys written to the journal and not yet flushed, per cluster.
+        self._pending = {}
+        self._pending_count = 0
+
+        self._open_journal()
+
+        replay_orphaned_journals(self.journal_dir, config.ingest_flush_max_keys)
+
+        self._flusher = threading.Thread(target=self._run_flusher, name='ingest-flusher', daemon=True)
+        self._flusher.start()
+
+        atexit.register(self.close)
+
+    def _open_journal(self):
+        # Locked under a hidden name first, so that no replayer ever takes a new journal for an orphaned one.
+        fd, temp_path = tempfile.mkstemp(prefix='.journal-', dir=self.journal_dir)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        self.journal_path = os.path.join(self.journal_dir, 'journal-%d-%s.log' % (
+            os.getpid(), os.path.basename(temp_path)[len('.journal-'):]))
+        os.rename(temp_path, self.journal_path)
+        # Fsyncing the journal keeps its records, but only the directory keeps its name after a power loss.
+        _fsync_dir(self.journal_dir)
+
+        self._fp = os.fdopen(fd, mode='ab')
+        self._written_offset = 0
+        self._synced_offset = 0
+        self._checkpoint = 0
+
+    def append(self, cluster_id, diagnosis_keys):
+        """Returns the keys that are new to the database and to this journal, once they are durable."""
+        session = Session()
+        try:
+            new_diagnosis_keys = filter_new_diagnosis_keys(session, cluster_id, diagnosis_keys)
+        finally:
+            session.close()
+
+        with self._lock:
+            pending = self._pending.setdefault(cluster_id, set())
+            new_diagnosis_keys = [dk for dk in new_diagnosis_keys if dk.key not in pending]
+            if len(new_diagnosis_keys) == 0:
+                return new_diagnosis_keys
+
+            rows = []
+            for diagnosis_key in new_diagnosis_keys:
+                row = diagnosis_key.to_row()
+                del row['upload_id']
+                rows.append(row)
+            line = json.dumps({'cluster_id': cluster_id, 'keys': rows}, separators=(',', ':')).encode('utf-8') + b'\n'
+
+            self._fp.write(line)
+            self._written_offset += len(line)
+            offset = self._written_offset
+            pending.update(dk.key for dk in new_diagnosis_keys)
+            self._pending_count += len(new_diagnosis_keys)
+            flush_now = self._pending_count >= self.config.ingest_flush_max_keys
+
+        self._sync(offset)
+
+        if flush_now:
+            self._flush_event.set()
+
+        return new_diagnosis_keys
+
+    def _sync(self, offset):
+        with self._sync_lock:
+            if self._synced_offset >= offset:
+                # Made durable by the fsync of another request.
+                return
+
+            with self._lock:
+                self._fp.flush()
+                target_offset = self._written_offset
+                fd = self._fp.fileno()
+
+            os.fsync(fd)
+            self._synced_offset = target_offset
+
+    def _run_flusher(self):
+        while not self._closed.is_set():
+            self._flush_event.wait(self.config.ingest_flush_interval_in_sec)
+            self._flush_event.clear()
+            try:
+                self.flush()
+            except Exception:
+                # Left in the journal and retried, e.g. when the database is locked.
+                logger.exception('Flushing %s failed.', self.journal_path)
+
+    def flush(self):
+        flushed = False
+        while True:
+            journal_path = self.journal_path
+            offset, records = _drain(journal_path, self._checkpoint, self._synced_offset,
+                                     self.config.ingest_flush_max_keys)
+            if len(records) == 0:
+                break
+            flushed = True
+
+            with self._lock:
+                self._checkpoint = offset
+                for record in records:
+                    pending = self._pending.get(record['cluster_id'], set())
+                    pending.difference_update(row['key'] for row in record['keys'])
+                    self._pending_count -= len(record['keys'])
+
+        if flushed and self.config.export_trigger_socket is not None:
+            notify(self.config.export_trigger_socket)
+
+        self._rotate()
+
+    def _rotate(self):
+        with self._lock:
+            if self._checkpoint < ROTATE_SIZE or self._checkpoint != self._written_offset:
+                return
+
+            old_fp = self._fp
+            old_journal_path = self.journal_path
+            self._open_journal()
+
+        os.remove(old_journal_path)
+        os.remove(_get_checkpoint_path(old_journal_path))
+        old_fp.close()
+
+    def close(self):
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        self._flush_event.set()
+        self._flusher.join()
+
+        try:
+            self.flush()
+        except Exception:
+            # Replayed by the next process that starts.
+            logger.exception('Flushing %s failed.', self.journal_path)
+            return
+
+        with self._lock:
+            if self._checkpoint != self._written_offset:
+                return
+            self._fp.close()
+            os.remove(self.journal_path)
+            if os.path.exists(_get_checkpoint_path(self.journal_path)):
+                os.remove(_get_checkpoint_path(self.journal_path))
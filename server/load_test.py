@@ -0,0 +1,279 @@
+import json
+import os
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from random import Random
+from urllib.parse import urlsplit
+
+from absl import app
+from absl import flags
+
+from ecdsa import SigningKey, NIST256p
+from sqlalchemy.exc import OperationalError
+
+from synthetic import generate_diagnosis_keys_payload, generate_exposure_data
+
+FLAGS = flags.FLAGS
+flags.DEFINE_integer("duration_sec", 30, "Length of the test")
+flags.DEFINE_integer("pollers", 8, "Threads that poll list.json, zips and CSVs")
+flags.DEFINE_integer("uploaders", 2, "Threads that put diagnosis-keys and exposure data in bursts")
+flags.DEFINE_integer("burst_size", 20, "Uploads per burst")
+flags.DEFINE_float("burst_interval_sec", 2.0, "Pause between the bursts of an uploader")
+flags.DEFINE_float("exposure_data_rate", 0.2, "Rate of uploads that are exposure data instead of diagnosis-keys")
+flags.DEFINE_integer("keys_per_upload", 14, "Diagnosis-keys per upload")
+flags.DEFINE_integer("windows_per_upload", 50, "Exposure windows per exposure data")
+flags.DEFINE_integer("clusters", 3, "Number of clusters")
+flags.DEFINE_float("export_interval_sec", 5.0, "Interval of the in-process exporter. 0 disables it")
+flags.DEFINE_string("config", '{}', "JSON object merged into the generated config.json, e.g. db_pool_class")
+flags.DEFINE_string("base_path", None, "Directory for the database and files. A temporary one is removed afterwards")
+flags.DEFINE_integer("seed", 0, "Random seed")
+flags.DEFINE_string("output_path", None, "File to which the results are written as JSON")
+
+PUT_DIAGNOSIS_KEYS = 'PUT /diagnosis_keys/<cluster_id>/<file_name>'
+GET_DIAGNOSIS_KEYS_LIST = 'GET /diagnosis_keys/<cluster_id>/list.json'
+GET_DIAGNOSIS_KEYS_ZIP = 'GET /diagnosis_keys/<cluster_id>/<zip_file_name>'
+PUT_EXPOSURE_DATA = 'PUT /exposure_data/<cluster_id>/'
+GET_EXPOSURE_DATA_LIST = 'GET /exposure_data/<cluster_id>/list.json'
+GET_EXPOSURE_DATA_CSV = 'GET /exposure_data/<cluster_id>/<identifier>/<type>'
+
+# Relative frequency of the requests of a poller. Routes without anything to get yet fall back to list.json.
+POLL_WEIGHTS = [
+    (GET_DIAGNOSIS_KEYS_LIST, 50),
+    (GET_DIAGNOSIS_KEYS_ZIP, 25),
+    (GET_EXPOSURE_DATA_LIST, 15),
+    (GET_EXPOSURE_DATA_CSV, 10),
+]
+
+REGION = 440
+
+
+class Stats(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+        self.lock_errors = defaultdict(int)
+        self.errors = defaultdict(int)
+
+    def record(self, route, latency, status=None, lock_error=False, error=False):
+        with self._lock:
+            self.latencies[route].append(latency)
+            if status is not None:
+                self.statuses[route][status] += 1
+            if lock_error:
+                self.lock_errors[route] += 1
+            if error:
+                self.errors[route] += 1
+
+
+class Targets(object):
+    """URLs learned from list.json responses, which pollers pick zips and CSVs from."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.zip_paths = []
+        self.csv_paths = []
+
+    def add(self, zip_paths=(), csv_paths=()):
+        with self._lock:
+            self.zip_paths = sorted(set(self.zip_paths).union(zip_paths))
+            self.csv_paths = sorted(set(self.csv_paths).union(csv_paths))
+
+    def choose(self, rand, paths):
+        with self._lock:
+            return rand.choice(getattr(self, paths)) if len(getattr(self, paths)) > 0 else None
+
+
+def _request(client, stats, route, method, path, **kwargs):
+    started = time.perf_counter()
+    try:
+        response = client.open(path, method=method, **kwargs)
+        # Streamed bodies are produced while they are read.
+        data = response.get_data()
+        stats.record(route, time.perf_counter() - started, status=response.status_code)
+        return response, data
+    except OperationalError as e:
+        stats.record(route, time.perf_counter() - started, lock_error='database is locked' in str(e),
+                     error='database is locked' not in str(e))
+    except Exception:
+        stats.record(route, time.perf_counter() - started, error=True)
+    return None, None
+
+
+def _path(url):
+    return urlsplit(url).path
+
+
+def _upload(web_api, stats, cluster_ids, rand, deadline):
+    client = web_api.app.test_client()
+    while time.time() < deadline:
+        for _ in range(FLAGS.burst_size):
+            cluster_id = rand.choice(cluster_ids)
+            if rand.random() < FLAGS.exposure_data_rate:
+                payload = generate_exposure_data(rand, FLAGS.windows_per_upload)
+                _request(client, stats, PUT_EXPOSURE_DATA, 'PUT', '/exposure_data/%s/' % cluster_id,
+                         data=json.dumps(payload))
+            else:
+                payload = generate_diagnosis_keys_payload(rand, FLAGS.keys_per_upload)
+                _request(client, stats, PUT_DIAGNOSIS_KEYS, 'PUT', '/diagnosis_keys/%s/upload.json' % cluster_id,
+                         data=json.dumps(payload))
+        time.sleep(FLAGS.burst_interval_sec)
+
+
+def _poll(web_api, stats, targets, cluster_ids, rand, deadline):
+    client = web_api.app.test_client()
+    routes = [route for route, _ in POLL_WEIGHTS]
+    weights = [weight for _, weight in POLL_WEIGHTS]
+    while time.time() < deadline:
+        route = rand.choices(routes, weights=weights)[0]
+        cluster_id = rand.choice(cluster_ids)
+
+        if route == GET_DIAGNOSIS_KEYS_ZIP:
+            zip_path = targets.choose(rand, 'zip_paths')
+            if zip_path is not None:
+                _request(client, stats, route, 'GET', zip_path)
+                continue
+            route = GET_DIAGNOSIS_KEYS_LIST
+        elif route == GET_EXPOSURE_DATA_CSV:
+            csv_path = targets.choose(rand, 'csv_paths')
+            if csv_path is not None:
+                _request(client, stats, route, 'GET', csv_path)
+                continue
+            route = GET_EXPOSURE_DATA_LIST
+
+        if route == GET_DIAGNOSIS_KEYS_LIST:
+            response, data = _request(client, stats, route, 'GET', '/diagnosis_keys/%s/list.json' % cluster_id)
+            if response is not None and response.status_code == 200:
+                targets.add(zip_paths=[_path(item['url']) for item in json.loads(data)])
+        else:
+            response, data = _request(client, stats, route, 'GET', '/exposure_data/%s/list.json' % cluster_id)
+            if response is not None and response.status_code == 200:
+                items = json.loads(data)
+                targets.add(csv_paths=[_path(item[key]) for item in items
+                                       for key in ['exposure_windows_csv_url', 'daily_summaries_csv_url']])
+
+
+def _export(config, stats, stop):
+    # Imported late: generate_diagnosis_keys shares the engine that web_api has created.
+    from generate_diagnosis_keys import export_diagnosis_keys
+
+    while not stop.wait(FLAGS.export_interval_sec):
+        started = time.perf_counter()
+        try:
+            export_diagnosis_keys(config)
+            stats.record('export', time.perf_counter() - started)
+        except OperationalError as e:
+            stats.record('export', time.perf_counter() - started, lock_error='database is locked' in str(e),
+                         error='database is locked' not in str(e))
+
+
+def _percentile(sorted_values, percent):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * percent / 100))]
+
+
+def _report(stats, elapsed):
+    results = []
+    print('%-52s %7s %8s %9s %9s %9s %6s %6s  %s' % (
+        'route', 'count', 'rps', 'p50 ms', 'p95 ms', 'p99 ms', 'locked', 'errors', 'statuses'))
+    for route in sorted(stats.latencies.keys()):
+        latencies = sorted(stats.latencies[route])
+        result = {
+            'route': route,
+            'count': len(latencies),
+            'rps': len(latencies) / elapsed,
+            'p50_ms': statistics.median(latencies) * 1000,
+            'p95_ms': _percentile(latencies, 95) * 1000,
+            'p99_ms': _percentile(latencies, 99) * 1000,
+            'lock_errors': stats.lock_errors[route],
+            'errors': stats.errors[route],
+            'statuses': dict(stats.statuses[route]),
+        }
+        results.append(result)
+        print('%-52s %7d %8.1f %9.1f %9.1f %9.1f %6d %6d  %s' % (
+            route, result['count'], result['rps'], result['p50_ms'], result['p95_ms'], result['p99_ms'],
+            result['lock_errors'], result['errors'],
+            ' '.join('%d:%d' % item for item in sorted(result['statuses'].items()))))
+    return results
+
+
+def main(argv):
+    del argv  # Unused.
+
+    base_path = FLAGS.base_path
+    temporary = base_path is None
+    if temporary:
+        base_path = tempfile.mkdtemp(prefix='en-load-test-')
+
+    try:
+        signing_key_path = os.path.join(base_path, 'private.pem')
+        with open(signing_key_path, mode='wb') as fp:
+            fp.write(SigningKey.generate(curve=NIST256p).to_pem())
+
+        config_obj = {
+            'region': REGION,
+            'base_url': 'http://localhost/',
+            'db_uri': 'sqlite:///%s' % os.path.join(base_path, 'load_test.db'),
+            'base_path': base_path,
+            'export-generate_bin_path': '',
+            'signing_key_path': signing_key_path,
+        }
+        config_obj.update(json.loads(FLAGS.config))
+
+        config_path = os.path.join(base_path, 'config.json')
+        with open(config_path, mode='w') as fp:
+            json.dump(config_obj, fp)
+
+        # web_api reads its configuration when it is imported.
+        os.environ['CONFIG_PATH'] = config_path
+        import web_api
+
+        # Errors raise out of the test client instead of becoming 500s, so that lock errors are told apart.
+        web_api.app.config['PROPAGATE_EXCEPTIONS'] = True
+
+        stats = Stats()
+        targets = Targets()
+        cluster_ids = ['%06d' % (100000 + index) for index in range(FLAGS.clusters)]
+        rand = Random(FLAGS.seed)
+
+        started = time.time()
+        deadline = started + FLAGS.duration_sec
+        threads = []
+        for _ in range(FLAGS.uploaders):
+            threads.append(threading.Thread(
+                target=_upload, args=(web_api, stats, cluster_ids, Random(rand.getrandbits(32)), deadline)))
+        for _ in range(FLAGS.pollers):
+            threads.append(threading.Thread(
+                target=_poll, args=(web_api, stats, targets, cluster_ids, Random(rand.getrandbits(32)), deadline)))
+
+        stop = threading.Event()
+        exporter = None
+        if FLAGS.export_interval_sec > 0:
+            exporter = threading.Thread(target=_export, args=(web_api.config, stats, stop))
+            exporter.start()
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        stop.set()
+        if exporter is not None:
+            exporter.join()
+
+        results = _report(stats, time.time() - started)
+
+        if FLAGS.output_path is not None:
+            with open(FLAGS.output_path, mode='w') as fp:
+                json.dump({'flags': FLAGS.flag_values_dict(), 'config': config_obj, 'results': results}, fp, indent=2)
+    finally:
+        if temporary:
+            shutil.rmtree(base_path, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    app.run(main)
@@ -0,0 +1,67 @@
+import json
+import os
+from datetime import datetime
+
+from common import FORMAT_RFC3339, JST, publish_file
+
+DIAGNOSIS_KEYS_DIR = 'diagnosis_keys'
+
+MANIFEST_FILE_NAME = 'list.json'
+
+
+def get_diagnosis_keys_dir(base_path, cluster_id):
+    return os.path.join(base_path, str(cluster_id), DIAGNOSIS_KEYS_DIR)
+
+
+def get_manifest_path(base_path, cluster_id):
+    return os.path.join(get_diagnosis_keys_dir(base_path, cluster_id), MANIFEST_FILE_NAME)
+
+
+def _create_item(config, cluster_id, file_name, created_timestamp):
+    url = os.path.join(config.base_url, DIAGNOSIS_KEYS_DIR, cluster_id, file_name)
+    created_datetime = datetime.fromtimestamp(created_timestamp).astimezone(JST)
+    return {
+        'region': config.region,
+        'url': url,
+        'created': int(created_timestamp),
+        'datetime': created_datetime.strftime(FORMAT_RFC3339)
+    }
+
+
+def scan_items(config, cluster_id):
+    zip_store_path = get_diagnosis_keys_dir(config.base_path, cluster_id)
+    if not os.path.exists(zip_store_path):
+        return []
+
+    filtered_zip_list = sorted(filter(lambda f: f.endswith('.zip'), os.listdir(zip_store_path)))
+
+    item_list = []
+    for file_name in filtered_zip_list:
+        created_timestamp = os.stat(os.path.join(zip_store_path, file_name)).st_mtime
+        item_list.append(_create_item(config, cluster_id, file_name, created_timestamp))
+
+    return item_list
+
+
+def encode_items(item_list):
+    return json.dumps(item_list, separators=(',', ':')).encode('utf-8')
+
+
+def publish_manifest(config, cluster_id, export_zip_paths):
+    manifest_path = get_manifest_path(config.base_path, cluster_id)
+
+    if os.path.exists(manifest_path):
+        with open(manifest_path, mode='rb') as fp:
+            item_list = json.load(fp)
+    else:
+        # First export since the manifest was introduced. The scan picks up the new zips as well.
+        item_list = scan_items(config, cluster_id)
+
+    listed_urls = set(map(lambda item: item['url'], item_list))
+    for export_zip_path in export_zip_paths:
+        item = _create_item(config, cluster_id, os.path.basename(export_zip_path),
+                            os.stat(export_zip_path).st_mtime)
+        if item['url'] not in listed_urls:
+            item_list.append(item)
+
+    return publish_file(encode_items(item_list), os.path.dirname(manifest_path), MANIFEST_FILE_NAME)
@@ -0,0 +1,161 @@
+import json
+import os
+import sys
+import time
+
+from sqlalchemy import inspect, text
+
+from scheme import Base, DiagnosisKeyUpload, ExportWatermark, ExposureData
+from configuration import Configuration
+from database import init_engine_from_configuration
+from exposure_data_store import SUFFIX_JSON, get_exposure_data_dir, iter_stored_files
+
+
+LEGACY_INDEX_NAMES = {
+    'diagnosis_keys': ['ix_diagnosis_keys_exported_cluster_id'],
+}
+
+
+def _add_missing_columns(engine):
+    inspector = inspect(engine)
+
+    for table in Base.metadata.sorted_tables:
+        existing_column_names = set(map(lambda column: column['name'], inspector.get_columns(table.name)))
+        for column in table.columns:
+            if column.name in existing_column_names:
+                continue
+            column_type = column.type.compile(dialect=engine.dialect)
+            with engine.begin() as connection:
+                connection.execute(text('ALTER TABLE %s ADD COLUMN %s %s' % (table.name, column.name, column_type)))
+            print('Column %s.%s has been added.' % (table.name, column.name))
+
+
+def _drop_legacy_indexes(engine):
+    inspector = inspect(engine)
+
+    for table_name, index_names in LEGACY_INDEX_NAMES.items():
+        existing_index_names = set(map(lambda index: index['name'], inspector.get_indexes(table_name)))
+        for index_name in index_names:
+            if index_name not in existing_index_names:
+                continue
+            with engine.begin() as connection:
+                connection.execute(text('DROP INDEX %s' % index_name))
+            print('Index %s has been dropped.' % index_name)
+
+
+def _assign_upload(connection, cluster_id, exported):
+    result = connection.execute(
+        DiagnosisKeyUpload.__table__.insert(),
+        {'cluster_id': cluster_id, 'createdAt': int(time.time())}
+    )
+    upload_id = result.inserted_primary_key[0]
+
+    connection.execute(
+        text('UPDATE diagnosis_keys SET upload_id = :upload_id'
+             ' WHERE cluster_id = :cluster_id AND upload_id IS NULL AND exported = :exported'),
+        {'upload_id': upload_id, 'cluster_id': cluster_id, 'exported': exported}
+    )
+
+    return upload_id
+
+
+def _migrate_exported_flags(engine):
+    # Rows written before the export watermark only carry the boolean "exported" flag.
+    column_names = set(map(lambda column: column['name'], inspect(engine).get_columns('diagnosis_keys')))
+    if 'exported' not in column_names:
+        return
+
+    with engine.begin() as connection:
+        rows = connection.execute(
+            text('SELECT cluster_id, exported FROM diagnosis_keys WHERE upload_id IS NULL'
+                 ' GROUP BY cluster_id, exported')
+        ).fetchall()
+
+        legacy_clusters = {}
+        for cluster_id, exported in rows:
+            legacy_clusters.setdefault(cluster_id, set()).add(bool(exported))
+
+        for cluster_id, exported_flags in legacy_clusters.items():
+            # Exported rows first, so that the unexported ones end up above the watermark.
+            if True in exported_flags:
+                upload_id = _assign_upload(connection, cluster_id, True)
+                connection.execute(
+                    ExportWatermark.__table__.insert(),
+                    {'cluster_id': cluster_id, 'upload_id': upload_id}
+                )
+            if False in exported_flags:
+                _assign_upload(connection, cluster_id, False)
+
+            print('Diagnosis-keys of cluster %s have been assigned to uploads.' % cluster_id)
+
+
+def _create_missing_indexes(engine):
+    inspector = inspect(engine)
+
+    for table in Base.metadata.sorted_tables:
+        existing_index_names = set(map(lambda index: index['name'], inspector.get_indexes(table.name)))
+        for index in table.indexes:
+            if index.name in existing_index_names:
+                continue
+            index.create(bind=engine)
+            print('Index %s has been created.' % index.name)
+
+
+def _index_exposure_data(engine, base_path):
+    # Uploads stored before the exposure_data table existed are only known from the file system.
+    if not os.path.exists(base_path):
+        return
+
+    with engine.begin() as connection:
+        indexed = set(map(tuple, connection.execute(
+            text('SELECT cluster_id, identifier FROM exposure_data')
+        ).fetchall()))
+
+        for cluster_id in sorted(os.listdir(base_path)):
+            if not os.path.isdir(get_exposure_data_dir(base_path, cluster_id)):
+                continue
+
+            rows = []
+            for identifier, suffix, file_path in iter_stored_files(base_path, cluster_id):
+                if suffix != SUFFIX_JSON or (cluster_id, identifier) in indexed:
+                    continue
+                created_timestamp = os.stat(file_path).st_mtime
+                rows.append({'cluster_id': cluster_id, 'identifier': identifier, 'createdAt': int(created_timestamp)})
+
+            if len(rows) > 0:
+                rows.sort(key=lambda row: row['createdAt'])
+                connection.execute(ExposureData.__table__.insert(), rows)
+                print('%d exposure-data of cluster %s have been indexed.' % (len(rows), cluster_id))
+
+
+def migrate(engine, base_path):
+    # create_all creates missing tables (with their indexes) but never alters existing ones.
+    Base.metadata.create_all(bind=engine)
+
+    _add_missing_columns(engine)
+    _drop_legacy_indexes(engine)
+    _create_missing_indexes(engine)
+    _migrate_exported_flags(engine)
+    _index_exposure_data(engine, base_path)
+
+
+def main(argv):
+    assert 'CONFIG_PATH' in os.environ, 'Env "CONFIG_PATH" must be set.'
+
+    config_path = os.environ['CONFIG_PATH']
+
+    assert os.path.exists(config_path), 'Config path %s is not exist.' % config_path
+
+    config = None
+    with open(config_path, mode='r') as fp:
+        config = Configuration(json.load(fp))
+
+    engine = init_engine_from_configuration(config)
+
+    migrate(engine, config.base_path)
+
+    print('Migration completed.')
+
+
+if __name__ == '__main__':
+    main(sys.argv)
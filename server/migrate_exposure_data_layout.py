@@ -0,0 +1,58 @@
+import json
+import os
+import sys
+
+from configuration import Configuration
+from exposure_data_store import get_exposure_data_dir, get_shard_dir, split_file_name
+
+
+def migrate_cluster(base_path, cluster_id):
+    exposure_data_dir = get_exposure_data_dir(base_path, cluster_id)
+
+    moved_count = 0
+    for file_name in os.listdir(exposure_data_dir):
+        identifier, _ = split_file_name(file_name)
+        if identifier is None:
+            continue
+
+        shard_dir = get_shard_dir(base_path, cluster_id, identifier)
+        os.makedirs(shard_dir, exist_ok=True)
+
+        # rename(2) within one file system: every file is always reachable under one of the two layouts.
+        os.rename(os.path.join(exposure_data_dir, file_name), os.path.join(shard_dir, file_name))
+        moved_count += 1
+
+    return moved_count
+
+
+def migrate(base_path):
+    if not os.path.exists(base_path):
+        return
+
+    for cluster_id in sorted(os.listdir(base_path)):
+        if not os.path.isdir(get_exposure_data_dir(base_path, cluster_id)):
+            continue
+
+        moved_count = migrate_cluster(base_path, cluster_id)
+        if moved_count > 0:
+            print('%d files of cluster %s have been moved.' % (moved_count, cluster_id))
+
+
+def main(argv):
+    assert 'CONFIG_PATH' in os.environ, 'Env "CONFIG_PATH" must be set.'
+
+    config_path = os.environ['CONFIG_PATH']
+
+    assert os.path.exists(config_path), 'Config path %s is not exist.' % config_path
+
+    config = None
+    with open(config_path, mode='r') as fp:
+        config = Configuration(json.load(fp))
+
+    migrate(config.base_path)
+
+    print('Migration completed.')
+
+
+if __name__ == '__main__':
+    main(sys.argv)
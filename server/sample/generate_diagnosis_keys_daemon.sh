@@ -0,0 +1,6 @@
+#!/bin/sh
+
+export CONFIG_PATH=$HOME/en-calibration-server/server/sample/config.json
+
+cd $HOME/en-calibration-server/server
+exec python3 generate_diagnosis_keys.py --daemon
@@ -0,0 +1,154 @@
+import fcntl
+import os
+
+import numpy as np
+
+SCAN_INSTANCES_DIR = 'scan_instances'
+LOCK_FILE_NAME = '.lock'
+
+MILLIS_PER_DAY = 24 * 60 * 60 * 1000
+
+# One append-only file of fixed-width values per column, named <column>.<dtype>.
+COLUMNS = [
+    ('MinAttenuationDb', np.dtype('u1')),
+    ('TypicalAttenuationDb', np.dtype('u1')),
+    ('SecondsSinceLastScan', np.dtype('<i4')),
+    ('CalibrationConfidence', np.dtype('u1')),
+    ('Infectiousness', np.dtype('u1')),
+    ('ReportType', np.dtype('u1')),
+    # Days since the epoch of DateMillisSinceEpoch.
+    ('Date', np.dtype('<i4')),
+    # id of the ExposureData the scan instance was put with.
+    ('UploadId', np.dtype('<i8')),
+]
+
+ATTENUATION_MAX_DB = 255
+
+
+def get_scan_instances_dir(base_path, cluster_id):
+    return os.path.join(base_path, str(cluster_id), SCAN_INSTANCES_DIR)
+
+
+def _get_column_path(scan_instances_dir, name, dtype):
+    return os.path.join(scan_instances_dir, '%s.%s' % (name, dtype.str.lstrip('<>|=')))
+
+
+def _count(scan_instances_dir):
+    # A write interrupted part way leaves some columns longer than others; only complete rows count.
+    counts = []
+    for name, dtype in COLUMNS:
+        column_path = _get_column_path(scan_instances_dir, name, dtype)
+        size = os.path.getsize(column_path) if os.path.exists(column_path) else 0
+        counts.append(size // dtype.itemsize)
+    return min(counts)
+
+
+def to_columns(exposure_windows):
+    """Flattens the scan instances of exposure windows into one array per column but UploadId.
+
+    Raises KeyError, TypeError, ValueError or OverflowError when exposure windows are malformed.
+    """
+    rows = [
+        (
+            si['MinAttenuationDb'], si['TypicalAttenuationDb'], si['SecondsSinceLastScan'],
+            ew['CalibrationConfidence'], ew['Infectiousness'], ew['ReportType'],
+            ew['DateMillisSinceEpoch'] // MILLIS_PER_DAY,
+        )
+        for ew in exposure_windows
+        for si in ew['ScanInstances']
+    ]
+    return {
+        name: np.array([row[index] for row in rows], dtype=dtype)
+        for index, (name, dtype) in enumerate(COLUMNS[:-1])
+    }
+
+
+def append(base_path, cluster_id, upload_id, columns):
+    columns = dict(columns, UploadId=np.full(len(columns['Date']), upload_id, dtype=np.int64))
+
+    scan_instances_dir = get_scan_instances_dir(base_path, cluster_id)
+    os.makedirs(scan_instances_dir, exist_ok=True)
+
+    with open(os.path.join(scan_instances_dir, LOCK_FILE_NAME), mode='a') as lock_fp:
+        fcntl.flock(lock_fp.fileno(), fcntl.LOCK_EX)
+
+        count = _count(scan_instances_dir)
+        for name, dtype in COLUMNS:
+            with open(_get_column_path(scan_instances_dir, name, dtype), mode='ab') as fp:
+                fp.truncate(count * dtype.itemsize)
+                fp.write(columns[name].astype(dtype, copy=False).tobytes())
+
+
+def load(base_path, cluster_id):
+    """Returns read-only memory maps of every column, all of the same length."""
+    scan_instances_dir = get_scan_instances_dir(base_path, cluster_id)
+    lock_path = os.path.join(scan_instances_dir, LOCK_FILE_NAME)
+
+    count = 0
+    if os.path.exists(lock_path):
+        with open(lock_path, mode='r') as lock_fp:
+            fcntl.flock(lock_fp.fileno(), fcntl.LOCK_SH)
+            count = _count(scan_instances_dir)
+
+    if count == 0:
+        return {name: np.empty(0, dtype=dtype) for name, dtype in COLUMNS}
+
+    # Rows appended later are beyond count and never read.
+    return {
+        name: np.memmap(_get_column_path(scan_instances_dir, name, dtype), dtype=dtype, mode='r', shape=(count,))
+        for name, dtype in COLUMNS
+    }
+
+
+def aggregate(columns, mask, bin_width):
+    """Attenuation histograms and duration-weighted attenuations per day of the rows selected by mask."""
+    # Widened from uint8, into which numpy 2 refuses to cast a bin_width above 255.
+    min_attenuation = columns['MinAttenuationDb'][mask].astype(np.int64)
+    typical_attenuation = columns['TypicalAttenuationDb'][mask].astype(np.int64)
+    seconds = columns['SecondsSinceLastScan'][mask].astype(np.int64)
+    dates = columns['Date'][mask]
+
+    bin_count = ATTENUATION_MAX_DB // bin_width + 1
+    min_bins = np.minimum(min_attenuation // bin_width, bin_count - 1)
+    typical_bins = np.minimum(typical_attenuation // bin_width, bin_count - 1)
+
+    histogram = {
+        'bin_width': bin_width,
+        'bin_starts': (np.arange(bin_count) * bin_width).tolist(),
+        'min_attenuation_count': np.bincount(min_bins, minlength=bin_count).tolist(),
+        'min_attenuation_seconds':
+            np.bincount(min_bins, weights=seconds, minlength=bin_count).astype(np.int64).tolist(),
+        'typical_attenuation_count': np.bincount(typical_bins, minlength=bin_count).tolist(),
+        'typical_attenuation_seconds':
+            np.bincount(typical_bins, weights=seconds, minlength=bin_count).astype(np.int64).tolist(),
+    }
+
+    days, day_index = np.unique(dates, return_inverse=True)
+    day_count = np.bincount(day_index, minlength=len(days))
+    day_seconds = np.bincount(day_index, weights=seconds, minlength=len(days))
+    day_min = np.bincount(day_index, weights=seconds * min_attenuation, minlength=len(days))
+    day_typical = np.bincount(day_index, weights=seconds * typical_attenuation, minlength=len(days))
+
+    # Days whose scan instances all have 0 seconds have no weighted attenuation.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weighted_min = np.where(day_seconds > 0, day_min / day_seconds, np.nan)
+        weighted_typical = np.where(day_seconds > 0, day_typical / day_seconds, np.nan)
+
+    daily = [
+        {
+            'date_millis_since_epoch': int(days[index]) * MILLIS_PER_DAY,
+            'count': int(day_count[index]),
+            'seconds': int(day_seconds[index]),
+            'weighted_min_attenuation_db': None if np.isnan(weighted_min[index]) else float(weighted_min[index]),
+            'weighted_typical_attenuation_db':
+                None if np.isnan(weighted_typical[index]) else float(weighted_typical[index]),
+        }
+        for index in range(len(days))
+    ]
+
+    return {
+        'count': int(np.count_nonzero(mask)),
+        'seconds': int(seconds.sum()),
+        'attenuation_histogram': histogram,
+        'daily': daily,
+    }
@@ -1,11 +1,27 @@
-from sqlalchemy import Integer, Column, String, Boolean
+from sqlalchemy import Integer, Column, String, Index, UniqueConstraint
 from sqlalchemy.orm import declarative_base
 
 Base = declarative_base()
 
 
+class DiagnosisKeyUpload(Base):
+    __tablename__ = 'diagnosis_key_uploads'
+    __table_args__ = (
+        Index('ix_diagnosis_key_uploads_cluster_id_id', 'cluster_id', 'id'),
+    )
+
+    # Monotonically increasing. Used as the export watermark.
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    cluster_id = Column(String(length=6), nullable=False)
+    createdAt = Column(Integer)
+
+
 class DiagnosisKey(Base):
     __tablename__ = 'diagnosis_keys'
+    __table_args__ = (
+        Index('ix_diagnosis_keys_cluster_id_key', 'cluster_id', 'key'),
+        Index('ix_diagnosis_keys_cluster_id_upload_id', 'cluster_id', 'upload_id'),
+    )
 
     primary_key = Column(String, primary_key=True)
     cluster_id = Column(String(length=6))
@@ -16,7 +32,10 @@ class DiagnosisKey(Base):
     transmissionRisk = Column(Integer)
     daysSinceOnsetOfSymptoms = Column(Integer)
     createdAt = Column(Integer)
-    exported = Column(Boolean, default=False)
+    upload_id = Column(Integer)
+
+    def to_row(self):
+        return {column.name: getattr(self, column.key) for column in self.__table__.columns}
 
     def to_serializable_object(self):
         return {
@@ -28,3 +47,47 @@ class DiagnosisKey(Base):
             'daysSinceOnsetOfSymptoms': self.daysSinceOnsetOfSymptoms,
             'createdAt': self.createdAt,
         }
+
+
+class ExportWatermark(Base):
+    __tablename__ = 'export_watermarks'
+
+    cluster_id = Column(String(length=6), primary_key=True)
+    # Every upload up to and including this id has been exported.
+    upload_id = Column(Integer, nullable=False)
+
+
+class ExportBatch(Base):
+    __tablename__ = 'export_batches'
+    __table_args__ = (
+        Index('ix_export_batches_cluster_id', 'cluster_id'),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    cluster_id = Column(String(length=6), nullable=False)
+    # Keys of the uploads in (from_upload_id, to_upload_id], ordered by (upload_id, primary_key),
+    # are split into batch_size files. This row records the batch_num-th of them.
+    from_upload_id = Column(Integer, nullable=False)
+    to_upload_id = Column(Integer, nullable=False)
+    batch_num = Column(Integer)
+    batch_size = Column(Integer)
+    key_count = Column(Integer)
+    file_name = Column(String)
+    createdAt = Column(Integer)
+
+
+class ExposureData(Base):
+    __tablename__ = 'exposure_data'
+    __table_args__ = (
+        UniqueConstraint('cluster_id', 'identifier', name='uq_exposure_data_cluster_id_identifier'),
+        Index('ix_exposure_data_cluster_id_created_at', 'cluster_id', 'createdAt', 'id'),
+        Index('ix_exposure_data_cluster_id_device', 'cluster_id', 'device'),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    cluster_id = Column(String(length=6), nullable=False)
+    # SHA-256 of the stored exposure data.
+    identifier = Column(String(length=64), nullable=False)
+    createdAt = Column(Integer, nullable=False)
+    # "id" of the exposure data, which names the device that put it.
+    device = Column(String(length=255), nullable=True)
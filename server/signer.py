@@ -0,0 +1,61 @@
+import hashlib
+
+from ecdsa import SigningKey
+from ecdsa.util import sigencode_der
+
+try:
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+except ImportError:
+    ec = None
+
+BACKEND_AUTO = 'auto'
+BACKEND_ECDSA = 'ecdsa'
+BACKEND_OPENSSL = 'openssl'
+
+
+class EcdsaSigner:
+    """Pure-Python ECDSA P-256 with SHA-256."""
+
+    name = BACKEND_ECDSA
+
+    def __init__(self, pem):
+        self._signing_key = SigningKey.from_pem(pem, hashlib.sha256)
+
+    def sign(self, data):
+        # X9.62 DER, as TEKSignature.signature expects.
+        return self._signing_key.sign(data, sigencode=sigencode_der)
+
+
+class OpenSSLSigner:
+    """ECDSA P-256 with SHA-256 through the OpenSSL bindings of the cryptography package."""
+
+    name = BACKEND_OPENSSL
+
+    def __init__(self, pem):
+        self._private_key = serialization.load_pem_private_key(pem.encode('utf-8'), password=None)
+        self._algorithm = ec.ECDSA(hashes.SHA256())
+
+    def sign(self, data):
+        # Already X9.62 DER.
+        return self._private_key.sign(data, self._algorithm)
+
+
+def is_openssl_available():
+    return ec is not None
+
+
+def create_signer(signing_key_path, backend=BACKEND_AUTO):
+    with open(signing_key_path) as fp:
+        pem = fp.read()
+
+    if backend == BACKEND_AUTO:
+        backend = BACKEND_OPENSSL if is_openssl_available() else BACKEND_ECDSA
+
+    if backend == BACKEND_OPENSSL:
+        assert is_openssl_available(), 'Signing backend "openssl" requires the cryptography package.'
+        return OpenSSLSigner(pem)
+    elif backend == BACKEND_ECDSA:
+        return EcdsaSigner(pem)
+
+    raise ValueError('Unknown signing backend %s.' % backend)
@@ -1,4 +1,7 @@
-from functools import cmp_to_key
+import numpy as np
+
+# Exposure windows from this many on are ordered by NumPy instead of sorted().
+VECTORIZED_SORT_THRESHOLD = 2000
 
 
 def sort_exposure_informations(exposure_informations):
@@ -15,69 +18,75 @@ def sort_daily_summaries(daily_summaries):
     return sorted(daily_summaries, key=lambda ds: ds['DateMillisSinceEpoch'])
 
 
+def _exposure_window_key(ew):
+    scan_instances = ew['ScanInstances']
+    return (
+        ew['DateMillisSinceEpoch'],
+        len(scan_instances),
+        sum(si['MinAttenuationDb'] for si in scan_instances),
+        sum(si['TypicalAttenuationDb'] for si in scan_instances),
+        sum(si['SecondsSinceLastScan'] for si in scan_instances),
+    )
+
+
+def _integer_array(values):
+    array = np.array(values, dtype=None if len(values) > 0 else np.int64)
+    return array if array.dtype.kind in 'iu' else None
+
+
+def _sort_exposure_windows_vectorized(exposure_windows):
+    """Returns None unless every value is an integer and their sums fit in int64, so that NumPy sums them exactly."""
+    dates = _integer_array([ew['DateMillisSinceEpoch'] for ew in exposure_windows])
+    lengths = np.array([len(ew['ScanInstances']) for ew in exposure_windows], dtype=np.int64)
+    scan_instances = [si for ew in exposure_windows for si in ew['ScanInstances']]
+    if dates is None:
+        return None
+
+    # Sum of the scan instances of window i is cumulative[ends[i]] - cumulative[starts[i]].
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    keys = [dates, lengths]
+    for name in ['MinAttenuationDb', 'TypicalAttenuationDb', 'SecondsSinceLastScan']:
+        values = _integer_array([si[name] for si in scan_instances])
+        if values is None:
+            return None
+        # Sums that could overflow int64 are left to sorted(), which sums Python integers.
+        if len(values) > 0 and max(-int(values.min()), int(values.max())) * len(values) >= 2 ** 63:
+            return None
+        cumulative = np.concatenate([[0], np.cumsum(values, dtype=np.int64)])
+        keys.append(cumulative[ends] - cumulative[starts])
+
+    # lexsort is stable and ascending with the last key first. Negating the keys orders them descending.
+    order = np.lexsort([-key for key in reversed(keys)])
+    return [exposure_windows[index] for index in order]
+
+
 def sort_exposure_windows(exposure_windows):
+    """Newest first, then by the number of scan instances and their total attenuations and seconds, descending.
+
+    Windows that tie keep their order.
+    """
     if exposure_windows is None:
         return exposure_windows
 
     for ew in exposure_windows:
         ew['ScanInstances'] = sort_scan_instances(ew['ScanInstances'])
 
-    def compare(l, r):
-        if l['DateMillisSinceEpoch'] < r['DateMillisSinceEpoch']:
-            return 1
-        if l['DateMillisSinceEpoch'] > r['DateMillisSinceEpoch']:
-            return -1
-
-        l_scan_instances_length = len(l['ScanInstances'])
-        r_scan_instances_length = len(r['ScanInstances'])
-        if l_scan_instances_length < r_scan_instances_length:
-            return 1
-        if l_scan_instances_length > r_scan_instances_length:
-            return -1
-
-        l_total_scan_instances_min_attenuation_db = sum(map(lambda si: si['MinAttenuationDb'], l['ScanInstances']))
-        r_total_scan_instances_min_attenuation_db = sum(map(lambda si: si['MinAttenuationDb'], r['ScanInstances']))
-        if l_total_scan_instances_min_attenuation_db < r_total_scan_instances_min_attenuation_db:
-            return 1
-        if l_total_scan_instances_min_attenuation_db > r_total_scan_instances_min_attenuation_db:
-            return -1
-
-        l_typical_attenuationDb = sum(map(lambda si: si['TypicalAttenuationDb'], l['ScanInstances']))
-        r_typical_attenuationDb = sum(map(lambda si: si['TypicalAttenuationDb'], r['ScanInstances']))
-        if l_typical_attenuationDb < r_typical_attenuationDb:
-            return 1
-        if l_typical_attenuationDb > r_typical_attenuationDb:
-            return -1
-
-        l_seconds_since_last_scan = sum(map(lambda si: si['SecondsSinceLastScan'], l['ScanInstances']))
-        r_seconds_since_last_scan = sum(map(lambda si: si['SecondsSinceLastScan'], r['ScanInstances']))
-        if l_seconds_since_last_scan < r_seconds_since_last_scan:
-            return 1
-        if l_seconds_since_last_scan > r_seconds_since_last_scan:
-            return -1
-
-        return 0
-
-    return sorted(exposure_windows, key=cmp_to_key(compare))
+    if len(exposure_windows) >= VECTORIZED_SORT_THRESHOLD:
+        sorted_exposure_windows = _sort_exposure_windows_vectorized(exposure_windows)
+        if sorted_exposure_windows is not None:
+            return sorted_exposure_windows
+
+    # Each key is computed once, instead of once per comparison. reverse=True keeps ties in their original order.
+    return sorted(exposure_windows, key=_exposure_window_key, reverse=True)
+
+
+def _scan_instance_key(si):
+    return si['MinAttenuationDb'], si['SecondsSinceLastScan'], si['TypicalAttenuationDb']
 
 
 def sort_scan_instances(scan_instances):
     if scan_instances is None:
         return scan_instances
 
-    def compare(l, r):
-        if l['MinAttenuationDb'] < r['MinAttenuationDb']:
-            return 1
-        if l['MinAttenuationDb'] > r['MinAttenuationDb']:
-            return -1
-        if l['SecondsSinceLastScan'] < r['SecondsSinceLastScan']:
-            return 1
-        if l['SecondsSinceLastScan'] > r['SecondsSinceLastScan']:
-            return -1
-        if l['TypicalAttenuationDb'] < r['TypicalAttenuationDb']:
-            return 1
-        if l['TypicalAttenuationDb'] > r['TypicalAttenuationDb']:
-            return -1
-        return 0
-
-    return sorted(scan_instances, key=cmp_to_key(compare))
+    return sorted(scan_instances, key=_scan_instance_key, reverse=True)
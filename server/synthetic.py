@@ -0,0 +1,123 @@
+"""Deterministic synthetic payloads for benchmarks and test databases.
+
+Every generator takes a random.Random, so that the same seed always produces the same data.
+"""
+import base64
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from common import FORMAT_RFC3339, TIMEWINDOW_IN_SEC
+from generate_diagnosis_keys import ExportKey
+
+# 2021-09-16T00:00:00Z, the date of sample/diagnosis_keys.json.
+BASE_ROLLING_START_NUMBER = 2718432
+ROLLING_PERIOD = 144
+KEY_DAYS = 14
+
+MILLIS_PER_DAY = 24 * 60 * 60 * 1000
+
+DAILY_SUMMARY_TYPES = [
+    'DaySummary', 'ConfirmedClinicalDiagnosisSummary', 'ConfirmedTestSummary', 'RecursiveSummary',
+    'SelfReportedSummary'
+]
+
+
+def generate_key(rand):
+    return base64.b64encode(rand.getrandbits(128).to_bytes(16, 'big')).decode()
+
+
+def generate_uuid(rand):
+    return str(uuid.UUID(int=rand.getrandbits(128), version=4)).upper()
+
+
+def rolling_start_number_to_datetime(rolling_start_number):
+    return datetime.fromtimestamp(rolling_start_number * TIMEWINDOW_IN_SEC, timezone.utc)
+
+
+def generate_temporary_exposure_keys(rand, count, base_rolling_start_number=BASE_ROLLING_START_NUMBER):
+    """Keys of the count days up to base_rolling_start_number, the newest one still rolling."""
+    return [
+        {
+            'key': generate_key(rand),
+            'rollingStartNumber': base_rolling_start_number - ROLLING_PERIOD * (index % KEY_DAYS),
+            'rollingPeriod': rand.randint(1, ROLLING_PERIOD) if index % KEY_DAYS == 0 else ROLLING_PERIOD,
+            'reportType': rand.randint(1, 4),
+        }
+        for index in range(count)
+    ]
+
+
+def generate_diagnosis_keys_payload(rand, key_count, base_rolling_start_number=BASE_ROLLING_START_NUMBER):
+    """Body of PUT /diagnosis_keys/<cluster_id>/<file_name>."""
+    symptom_onset_date = rolling_start_number_to_datetime(base_rolling_start_number) \
+        - timedelta(days=rand.randint(0, KEY_DAYS - 1))
+    return {
+        'symptomOnsetDate': symptom_onset_date.strftime(FORMAT_RFC3339),
+        'idempotencyKey': generate_uuid(rand),
+        'temporaryExposureKeys': generate_temporary_exposure_keys(rand, key_count, base_rolling_start_number),
+    }
+
+
+def generate_export_keys(rand, count, created_at=1631750400):
+    return [
+        ExportKey(
+            key=generate_key(rand),
+            transmissionRisk=4,
+            rollingStartNumber=BASE_ROLLING_START_NUMBER - ROLLING_PERIOD * (index % KEY_DAYS),
+            rollingPeriod=ROLLING_PERIOD,
+            reportType=rand.randint(1, 4),
+            daysSinceOnsetOfSymptoms=rand.randint(-14, 14),
+            createdAt=created_at + index
+        )
+        for index in range(count)
+    ]
+
+
+def generate_scan_instances(rand, count):
+    scan_instances = []
+    for _ in range(count):
+        min_attenuation_db = rand.randint(0, 80)
+        scan_instances.append({
+            'MinAttenuationDb': min_attenuation_db,
+            'SecondsSinceLastScan': rand.choice([180, 240, 300]),
+            'TypicalAttenuationDb': min_attenuation_db + rand.randint(0, 10),
+        })
+    return scan_instances
+
+
+def generate_exposure_windows(rand, count, max_scan_instances=30,
+                              base_date_millis=BASE_ROLLING_START_NUMBER * TIMEWINDOW_IN_SEC * 1000):
+    # Few distinct days and lengths, so that sorting has to compare the sums and meets ties.
+    return [
+        {
+            'CalibrationConfidence': rand.randint(0, 3),
+            'DateMillisSinceEpoch': base_date_millis - MILLIS_PER_DAY * rand.randint(0, KEY_DAYS - 1),
+            'Infectiousness': rand.randint(1, 2),
+            'ReportType': rand.randint(1, 4),
+            'ScanInstances': generate_scan_instances(rand, rand.randint(1, max_scan_instances)),
+        }
+        for _ in range(count)
+    ]
+
+
+def generate_daily_summaries(exposure_windows):
+    daily_summaries = []
+    for date_millis in sorted(set(map(lambda ew: ew['DateMillisSinceEpoch'], exposure_windows))):
+        daily_summary = {'DateMillisSinceEpoch': date_millis}
+        for type in DAILY_SUMMARY_TYPES:
+            daily_summary[type] = {'MaximumScore': 0.0, 'ScoreSum': 0.0, 'WeightedDurationSum': 0.0}
+        daily_summaries.append(daily_summary)
+    return daily_summaries
+
+
+def generate_exposure_data(rand, window_count, device='Pixel_3'):
+    """Body of PUT /exposure_data/<cluster_id>/."""
+    exposure_windows = generate_exposure_windows(rand, window_count)
+    return {
+        'id': '%s-%d' % (device, rand.getrandbits(31)),
+        'en_version': '1.8.3',
+        'exposure_configuration': {},
+        'daily_summaries': generate_daily_summaries(exposure_windows),
+        'exposure_windows': exposure_windows,
+        'generated_at': '2021-09-16T00:00:00.000+09:00',
+    }
@@ -0,0 +1,153 @@
+"""Equivalence of the keyed and vectorized sorts with the cmp_to_key comparators they replaced."""
+import copy
+from functools import cmp_to_key
+from random import Random
+
+import pytest
+
+from sorter import VECTORIZED_SORT_THRESHOLD, _sort_exposure_windows_vectorized, sort_exposure_windows, \
+    sort_scan_instances
+
+
+def _reference_sort_scan_instances(scan_instances):
+    def compare(l, r):
+        if l['MinAttenuationDb'] < r['MinAttenuationDb']:
+            return 1
+        if l['MinAttenuationDb'] > r['MinAttenuationDb']:
+            return -1
+        if l['SecondsSinceLastScan'] < r['SecondsSinceLastScan']:
+            return 1
+        if l['SecondsSinceLastScan'] > r['SecondsSinceLastScan']:
+            return -1
+        if l['TypicalAttenuationDb'] < r['TypicalAttenuationDb']:
+            return 1
+        if l['TypicalAttenuationDb'] > r['TypicalAttenuationDb']:
+            return -1
+        return 0
+
+    return sorted(scan_instances, key=cmp_to_key(compare))
+
+
+def _reference_sort_exposure_windows(exposure_windows):
+    for ew in exposure_windows:
+        ew['ScanInstances'] = _reference_sort_scan_instances(ew['ScanInstances'])
+
+    def compare(l, r):
+        if l['DateMillisSinceEpoch'] < r['DateMillisSinceEpoch']:
+            return 1
+        if l['DateMillisSinceEpoch'] > r['DateMillisSinceEpoch']:
+            return -1
+
+        l_scan_instances_length = len(l['ScanInstances'])
+        r_scan_instances_length = len(r['ScanInstances'])
+        if l_scan_instances_length < r_scan_instances_length:
+            return 1
+        if l_scan_instances_length > r_scan_instances_length:
+            return -1
+
+        for name in ['MinAttenuationDb', 'TypicalAttenuationDb', 'SecondsSinceLastScan']:
+            l_total = sum(map(lambda si: si[name], l['ScanInstances']))
+            r_total = sum(map(lambda si: si[name], r['ScanInstances']))
+            if l_total < r_total:
+                return 1
+            if l_total > r_total:
+                return -1
+
+        return 0
+
+    return sorted(exposure_windows, key=cmp_to_key(compare))
+
+
+def _generate_scan_instances(rand, count, value):
+    # Narrow ranges, so that most comparisons meet ties.
+    return [
+        {
+            'MinAttenuationDb': value(rand, 3),
+            'SecondsSinceLastScan': value(rand, 2) * 60,
+            'TypicalAttenuationDb': value(rand, 3),
+            'Id': index,
+        }
+        for index in range(count)
+    ]
+
+
+def _generate_exposure_windows(rand, count, value, max_scan_instances=3):
+    return [
+        {
+            'DateMillisSinceEpoch': 1630281600000 - 86400000 * rand.randrange(3),
+            # Empty ScanInstances included.
+            'ScanInstances': _generate_scan_instances(rand, rand.randint(0, max_scan_instances), value),
+            'Id': index,
+        }
+        for index in range(count)
+    ]
+
+
+def _integer(rand, limit):
+    return rand.randrange(limit)
+
+
+def _float(rand, limit):
+    return rand.randrange(limit) + rand.choice([0.0, 0.5])
+
+
+def _ids(items):
+    return [item['Id'] for item in items]
+
+
+def _assert_same_order(exposure_windows):
+    expected = _reference_sort_exposure_windows(copy.deepcopy(exposure_windows))
+    actual = sort_exposure_windows(copy.deepcopy(exposure_windows))
+
+    assert _ids(actual) == _ids(expected)
+    assert [_ids(ew['ScanInstances']) for ew in actual] == [_ids(ew['ScanInstances']) for ew in expected]
+
+
+@pytest.mark.parametrize('value', [_integer, _float])
+@pytest.mark.parametrize('seed', range(5))
+def test_sort_scan_instances(value, seed):
+    scan_instances = _generate_scan_instances(Random(seed), 200, value)
+
+    assert _ids(sort_scan_instances(scan_instances)) == _ids(_reference_sort_scan_instances(scan_instances))
+
+
+@pytest.mark.parametrize('count', [0, 1, 2, 50, VECTORIZED_SORT_THRESHOLD - 1])
+@pytest.mark.parametrize('value', [_integer, _float])
+def test_sort_exposure_windows_keyed(count, value):
+    _assert_same_order(_generate_exposure_windows(Random(count), count, value))
+
+
+@pytest.mark.parametrize('count', [VECTORIZED_SORT_THRESHOLD, VECTORIZED_SORT_THRESHOLD * 3])
+def test_sort_exposure_windows_vectorized(count):
+    exposure_windows = _generate_exposure_windows(Random(count), count, _integer)
+
+    assert _sort_exposure_windows_vectorized(exposure_windows) is not None
+    _assert_same_order(exposure_windows)
+
+
+@pytest.mark.parametrize('count', [VECTORIZED_SORT_THRESHOLD, VECTORIZED_SORT_THRESHOLD * 3])
+def test_sort_exposure_windows_vectorized_falls_back_on_floats(count):
+    exposure_windows = _generate_exposure_windows(Random(count), count, _float)
+
+    assert _sort_exposure_windows_vectorized(exposure_windows) is None
+    _assert_same_order(exposure_windows)
+
+
+def test_sort_exposure_windows_vectorized_without_scan_instances():
+    _assert_same_order(_generate_exposure_windows(Random(0), VECTORIZED_SORT_THRESHOLD, _integer,
+                                                  max_scan_instances=0))
+
+
+def test_sort_exposure_windows_vectorized_large_sums():
+    exposure_windows = _generate_exposure_windows(Random(0), VECTORIZED_SORT_THRESHOLD, _integer)
+    for ew in exposure_windows:
+        for si in ew['ScanInstances']:
+            # Each value fits in int64, but the sums of two or more do not.
+            si['MinAttenuationDb'] += 2 ** 62
+
+    _assert_same_order(exposure_windows)
+
+
+def test_sort_none():
+    assert sort_exposure_windows(None) is None
+    assert sort_scan_instances(None) is None
@@ -1,27 +1,53 @@
+import functools
+import gzip
 import hashlib
 import json
+import logging
 import os
-from datetime import datetime, timezone, timedelta
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 from http import HTTPStatus
 import uuid
-import csv
+from urllib.parse import urlencode
 
+import numpy as np
 from flask import Flask, send_file, request, Response
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, scoped_session
-
-from common import convert_to_diagnosis_key, is_exists, FORMAT_RFC3339
-from scheme import Base
+from sqlalchemy import and_, or_
+from sqlalchemy.exc import IntegrityError
+from common import convert_to_diagnosis_key, insert_diagnosis_keys, publish_chunks, publish_file, FORMAT_RFC3339, JST
+from scheme import Base, ExposureData
 from configuration import Configuration
+from database import Session, init_engine_from_configuration
+from export_trigger import notify
+from manifest import DIAGNOSIS_KEYS_DIR, encode_items, get_manifest_path, scan_items
+from exposure_data_store import EXPOSURE_DATA_DIR, SUFFIX_JSON, SUFFIX_JSON_GZIP, SUFFIX_EXPOSURE_WINDOWS_CSV, \
+    SUFFIX_DAILY_SUMMARIES_CSV, get_shard_dir, is_identifier, resolve_file_path, split_file_name
+from ingest_journal import IngestJournal
+from exposure_data_csv import CSV_TYPES, append_datasets, encode_csv, read_dataset
+import scan_instance_store
 from sorter import sort_daily_summaries, sort_exposure_windows, sort_exposure_informations
 
-JST = timezone(timedelta(hours=9), 'Asia/Tokyo')
-
-DIAGNOSIS_KEYS_DIR = 'diagnosis_keys'
-EXPOSURE_DATA_DIR = 'exposure_data'
 
 MAXIMUM_CONTENT_LENGTH = 1024 * 1024 * 20  # 20MiB
 
+# Precompressed copy stored next to each exposure data file.
+GZIP_COMPRESS_LEVEL = 6
+
+# Export zips never change once published.
+IMMUTABLE_MAX_AGE_IN_SEC = 60 * 60 * 24 * 365
+
+OFFLOAD_X_ACCEL_REDIRECT = 'x-accel-redirect'
+OFFLOAD_X_SENDFILE = 'x-sendfile'
+
+DEFAULT_LIST_LIMIT = 100
+MAXIMUM_LIST_LIMIT = 1000
+
+DEFAULT_ATTENUATION_BIN_WIDTH = 5
+
+# Raised by scan_instance_store.to_columns() on malformed scan instances.
+SCAN_INSTANCE_ERRORS = (KeyError, TypeError, ValueError, OverflowError)
+
 assert 'CONFIG_PATH' in os.environ, 'Env "CONFIG_PATH" must be set.'
 
 config_path = os.environ['CONFIG_PATH']
@@ -32,28 +58,24 @@ config = None
 with open(config_path, mode='r') as fp:
     config = Configuration(json.load(fp))
 
+assert config.download_offload in [None, OFFLOAD_X_ACCEL_REDIRECT, OFFLOAD_X_SENDFILE], \
+    'Unknown download_offload %s.' % config.download_offload
+
 if not os.path.exists(config.base_path):
     os.makedirs(config.base_path)
 
-engine = create_engine(
-    config.db_uri,
-    encoding="utf-8",
-    echo=True
-)
+engine = init_engine_from_configuration(config)
 
 Base.metadata.create_all(bind=engine)
 
 app = Flask(__name__)
 
+logger = logging.getLogger('web_api')
 
-def _create_session():
-    return scoped_session(
-        sessionmaker(
-            autocommit=False,
-            autoflush=False,
-            bind=engine
-        )
-    )
+
+@app.teardown_appcontext
+def _remove_session(exception=None):
+    Session.remove()
 
 
 MIMETYPE_JSON = 'application/json'
@@ -61,45 +83,122 @@ MIMETYPE_ZIP = 'application/zip'
 MIMETYPE_CSV = 'text/csv'
 
 
+# cluster_id -> (mtime_ns, size, content, etag) of the last manifest served by this process.
+_manifest_cache = {}
+
+
+def _load_manifest(cluster_id):
+    manifest_path = get_manifest_path(config.base_path, cluster_id)
+    try:
+        stat = os.stat(manifest_path)
+    except FileNotFoundError:
+        return None
+
+    cached = _manifest_cache.get(cluster_id)
+    if cached is not None and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+        return cached
+
+    with open(manifest_path, mode='rb') as fp:
+        content = fp.read()
+    cached = (stat.st_mtime_ns, stat.st_size, content, hashlib.sha256(content).hexdigest())
+    _manifest_cache[cluster_id] = cached
+
+    return cached
+
+
 @app.route("/diagnosis_keys/<cluster_id>/list.json", methods=['GET'])
 def diagnosis_keys_index(cluster_id):
-    zip_store_path = os.path.join(config.base_path, cluster_id, DIAGNOSIS_KEYS_DIR)
-    if not os.path.exists(zip_store_path):
-        return "[]"
+    manifest = _load_manifest(cluster_id)
+
+    if manifest is None:
+        # Not exported since the manifest was introduced.
+        content = encode_items(scan_items(config, cluster_id))
+        etag = hashlib.sha256(content).hexdigest()
+        last_modified = None
+    else:
+        mtime_ns, _, content, etag = manifest
+        last_modified = datetime.fromtimestamp(mtime_ns / 1e9, timezone.utc)
+
+    response = Response(response=content,
+                        status=HTTPStatus.OK,
+                        mimetype=MIMETYPE_JSON)
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.cache_control.no_cache = True
+
+    return response.make_conditional(request)
+
+
+@functools.lru_cache(maxsize=4096)
+def _content_hash(file_path, mtime_ns, size):
+    # mtime_ns and size are only part of the cache key.
+    sha256 = hashlib.sha256()
+    with open(file_path, mode='rb') as fp:
+        for chunk in iter(lambda: fp.read(1024 * 64), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
 
-    filtered_zip_list = list(filter(lambda f: f.endswith('.zip'), os.listdir(zip_store_path)))
 
-    item_list = []
+def _offload_response(cluster_id, zip_file_name, zip_file_path):
+    response = Response(status=HTTPStatus.OK, mimetype=MIMETYPE_ZIP)
+    response.headers['Content-Disposition'] = 'attachment; filename=%s' % zip_file_name
 
-    for file_name in filtered_zip_list:
-        url = os.path.join(config.base_url, DIAGNOSIS_KEYS_DIR, cluster_id, file_name)
-        path = os.path.join(config.base_path, cluster_id, DIAGNOSIS_KEYS_DIR, file_name)
-        created_timestamp = os.stat(path).st_mtime
-        created_datetime = datetime.fromtimestamp(created_timestamp).astimezone(JST)
-        item = {
-            'region': config.region,
-            'url': url,
-            'created': int(created_timestamp),
-            'datetime': created_datetime.strftime(FORMAT_RFC3339)
-        }
-        item_list.append(item)
-    json_str = json.dumps(item_list, indent=4)
+    if config.download_offload == OFFLOAD_X_ACCEL_REDIRECT:
+        response.headers['X-Accel-Redirect'] = '/'.join([
+            config.download_offload_prefix.rstrip('/'), cluster_id, DIAGNOSIS_KEYS_DIR, zip_file_name
+        ])
+    else:
+        response.headers['X-Sendfile'] = os.path.abspath(zip_file_path)
 
-    return Response(response=json_str,
-                    status=HTTPStatus.OK,
-                    mimetype=MIMETYPE_JSON)
+    return response
 
 
 @app.route("/diagnosis_keys/<cluster_id>/<zip_file_name>", methods=['GET'])
 def diagnosis_keys(cluster_id, zip_file_name):
     zip_file_path = os.path.join(config.base_path, cluster_id, DIAGNOSIS_KEYS_DIR, zip_file_name)
-    if not os.path.exists(zip_file_path):
+    if not zip_file_name.endswith('.zip') or not os.path.exists(zip_file_path):
         return "ClusterID:%s, %s not found" % (cluster_id, zip_file_name), HTTPStatus.NOT_FOUND
 
-    return send_file(zip_file_path,
-                     as_attachment=True,
-                     attachment_filename=zip_file_name,
-                     mimetype=MIMETYPE_ZIP)
+    stat = os.stat(zip_file_path)
+    etag = _content_hash(zip_file_path, stat.st_mtime_ns, stat.st_size)
+
+    if config.download_offload is not None:
+        # The front proxy serves the bytes, including Range requests.
+        response = _offload_response(cluster_id, zip_file_name, zip_file_path)
+        response.set_etag(etag)
+        response = response.make_conditional(request)
+    else:
+        # conditional=True answers If-None-Match and Range requests.
+        response = send_file(zip_file_path,
+                             as_attachment=True,
+                             attachment_filename=zip_file_name,
+                             mimetype=MIMETYPE_ZIP,
+                             conditional=True,
+                             etag=etag,
+                             max_age=IMMUTABLE_MAX_AGE_IN_SEC)
+
+    response.cache_control.public = True
+    response.cache_control.max_age = IMMUTABLE_MAX_AGE_IN_SEC
+    response.cache_control.immutable = True
+
+    return response
+
+
+_ingest_journal = None
+_ingest_journal_lock = threading.Lock()
+
+
+def _get_ingest_journal():
+    global _ingest_journal
+
+    # Created on first use, so that each uwsgi worker has its own journal and flusher thread.
+    # Locked, so that concurrent first requests of a threaded worker share one.
+    with _ingest_journal_lock:
+        if _ingest_journal is None:
+            _ingest_journal = IngestJournal(config)
+
+    return _ingest_journal
 
 
 @app.route("/diagnosis_keys/<cluster_id>/<file_name>", methods=['PUT'])
@@ -122,17 +221,20 @@ def put_diagnosis_keys(cluster_id, file_name):
     except KeyError as e:
         return '', HTTPStatus.BAD_REQUEST
 
-    session = _create_session()
+    if config.ingest_journal_dir is not None:
+        # Inserted and notified by the flusher of the journal.
+        filtered_diagnosis_keys = _get_ingest_journal().append(cluster_id, diagnosis_keys)
+    else:
+        session = Session()
 
-    filtered_diagnosis_keys = list(
-        filter(lambda diagnosis_key: not is_exists(session, cluster_id, diagnosis_key), diagnosis_keys)
-    )
+        try:
+            filtered_diagnosis_keys = insert_diagnosis_keys(session, cluster_id, diagnosis_keys)
+            session.commit()
+        finally:
+            session.close()
 
-    try:
-        session.bulk_save_objects(filtered_diagnosis_keys)
-        session.commit()
-    finally:
-        session.close()
+        if len(filtered_diagnosis_keys) > 0 and config.export_trigger_socket is not None:
+            notify(config.export_trigger_socket)
 
     response_diagnosis_keys \
         = list(map(lambda diagnosis_key: diagnosis_key.to_serializable_object(), filtered_diagnosis_keys))
@@ -144,41 +246,130 @@ def put_diagnosis_keys(cluster_id, file_name):
     )
 
 
+def _create_exposure_data_item(cluster_id, identifier, created_timestamp):
+    file_name = identifier + SUFFIX_JSON
+    json_url = os.path.join(config.base_url, EXPOSURE_DATA_DIR, cluster_id, file_name)
+    exposure_windows_csv_url = os.path.join(config.base_url, EXPOSURE_DATA_DIR, cluster_id, identifier,
+                                            "exposure_windows.csv")
+    daily_summaries_csv_url = os.path.join(config.base_url, EXPOSURE_DATA_DIR, cluster_id, identifier,
+                                           "daily_summaries.csv")
+    created_datetime = datetime.fromtimestamp(created_timestamp).astimezone(JST)
+    return {
+        'url': json_url,
+        'exposure_windows_csv_url': exposure_windows_csv_url,
+        'daily_summaries_csv_url': daily_summaries_csv_url,
+        'created': int(created_timestamp),
+        'datetime': created_datetime.strftime(FORMAT_RFC3339)
+    }
+
+
 @app.route("/exposure_data/<cluster_id>/list.json", methods=['GET'])
 def exposure_data_index(cluster_id):
-    json_store_path = os.path.join(config.base_path, cluster_id, EXPOSURE_DATA_DIR)
-    if not os.path.exists(json_store_path):
-        return "[]"
-
-    filtered_json_list = list(filter(lambda f: f.endswith('.json'), os.listdir(json_store_path)))
-
-    item_list = []
-
-    for file_name in filtered_json_list:
-        identifier, _ = os.path.splitext(file_name)
-        json_url = os.path.join(config.base_url, EXPOSURE_DATA_DIR, cluster_id, file_name)
-        exposure_windows_csv_url = os.path.join(config.base_url, EXPOSURE_DATA_DIR, cluster_id, identifier,
-                                                "exposure_windows.csv")
-        daily_summaries_csv_url = os.path.join(config.base_url, EXPOSURE_DATA_DIR, cluster_id, identifier,
-                                               "daily_summaries.csv")
-        path = os.path.join(config.base_path, cluster_id, EXPOSURE_DATA_DIR, file_name)
-        created_timestamp = os.stat(path).st_mtime
-        created_datetime = datetime.fromtimestamp(created_timestamp).astimezone(JST)
-        item = {
-            'url': json_url,
-            'exposure_windows_csv_url': exposure_windows_csv_url,
-            'daily_summaries_csv_url': daily_summaries_csv_url,
-            'created': int(created_timestamp),
-            'datetime': created_datetime.strftime(FORMAT_RFC3339)
-        }
-        item_list.append(item)
-
-    item_list = sorted(item_list, key=lambda item: item['created'], reverse=True)
-
-    json_str = json.dumps(item_list, indent=4)
+    """Newest first. Pages through ?before=<created>, ?since=<created> and ?limit=.
+
+    The "next" Link also carries before_id, which breaks ties between uploads created in the same second.
+    """
+    limit = request.args.get('limit', default=DEFAULT_LIST_LIMIT, type=int)
+    before = request.args.get('before', default=None, type=int)
+    before_id = request.args.get('before_id', default=None, type=int)
+    since = request.args.get('since', default=None, type=int)
+
+    limit = max(1, min(limit, MAXIMUM_LIST_LIMIT))
+
+    session = Session()
+    try:
+        query = session.query(ExposureData.id, ExposureData.identifier, ExposureData.createdAt) \
+            .filter(ExposureData.cluster_id == cluster_id)
+        if before is not None and before_id is not None:
+            query = query.filter(or_(
+                ExposureData.createdAt < before,
+                and_(ExposureData.createdAt == before, ExposureData.id < before_id)
+            ))
+        elif before is not None:
+            query = query.filter(ExposureData.createdAt < before)
+        if since is not None:
+            query = query.filter(ExposureData.createdAt > since)
+
+        rows = query.order_by(ExposureData.createdAt.desc(), ExposureData.id.desc()) \
+            .limit(limit) \
+            .all()
+    finally:
+        session.close()
+
+    item_list = list(map(lambda row: _create_exposure_data_item(cluster_id, row.identifier, row.createdAt), rows))
+
+    response = Response(
+        response=json.dumps(item_list, separators=(',', ':')),
+        status=HTTPStatus.OK,
+        mimetype=MIMETYPE_JSON
+    )
+
+    if len(rows) == limit:
+        next_args = dict(request.args)
+        next_args['before'] = rows[-1].createdAt
+        next_args['before_id'] = rows[-1].id
+        next_args['limit'] = limit
+        # From base_url like the items, since the request may have come through the proxy under another URL.
+        next_url = os.path.join(config.base_url, EXPOSURE_DATA_DIR, cluster_id, 'list.json')
+        response.headers['Link'] = '<%s?%s>; rel="next"' % (next_url, urlencode(next_args))
+
+    return response
+
+
+@app.route("/exposure_data/<cluster_id>/exposure_windows.csv", methods=['GET'], defaults={'name': 'exposure_windows.csv'})
+@app.route("/exposure_data/<cluster_id>/daily_summaries.csv", methods=['GET'], defaults={'name': 'daily_summaries.csv'})
+def exposure_data_dataset(cluster_id, name):
+    """Rows of every upload of the cluster, oldest first. ?since=<created> leaves out uploads created until then."""
+    since = request.args.get('since', default=None, type=int)
+
+    return _csv_response(read_dataset(config.base_path, cluster_id, name, since), name)
+
+
+def _parse_date(value):
+    """Days since the epoch of a YYYY-MM-DD date in UTC."""
+    date = datetime.strptime(value, '%Y-%m-%d').replace(tzinfo=timezone.utc)
+    return (date - datetime.fromtimestamp(0, timezone.utc)).days
+
+
+@app.route("/exposure_data/<cluster_id>/scan_instances/aggregate.json", methods=['GET'])
+def scan_instances_aggregate(cluster_id):
+    """Aggregates scan instances of exposure windows.
+
+    Filtered by ?from= and ?to= (YYYY-MM-DD, inclusive) on the date of the exposure window and by ?device=,
+    which matches the "id" of the exposure data with or without its "-<number>" suffix.
+    Attenuations are put into ?bin_width= dB bins (default 5).
+    """
+    bin_width = request.args.get('bin_width', default=DEFAULT_ATTENUATION_BIN_WIDTH, type=int)
+    device = request.args.get('device', default=None)
+    try:
+        date_from = _parse_date(request.args['from']) if 'from' in request.args else None
+        date_to = _parse_date(request.args['to']) if 'to' in request.args else None
+    except ValueError:
+        return Response(response='{}', status=HTTPStatus.BAD_REQUEST, mimetype=MIMETYPE_JSON)
+
+    if bin_width < 1:
+        return Response(response='{}', status=HTTPStatus.BAD_REQUEST, mimetype=MIMETYPE_JSON)
+
+    columns = scan_instance_store.load(config.base_path, cluster_id)
+
+    mask = np.ones(len(columns['Date']), dtype=bool)
+    if date_from is not None:
+        mask &= columns['Date'] >= date_from
+    if date_to is not None:
+        mask &= columns['Date'] <= date_to
+    if device is not None:
+        session = Session()
+        try:
+            upload_ids = [row.id for row in session.query(ExposureData.id).filter(
+                ExposureData.cluster_id == cluster_id,
+                or_(ExposureData.device == device, ExposureData.device.startswith(device + '-', autoescape=True))
+            )]
+        finally:
+            session.close()
+        mask &= np.isin(columns['UploadId'], np.array(upload_ids, dtype=np.int64))
 
     return Response(
-        response=json_str,
+        response=json.dumps(scan_instance_store.aggregate(columns, mask, bin_width), separators=(',', ':')),
         status=HTTPStatus.OK,
         mimetype=MIMETYPE_JSON
     )
@@ -186,109 +377,104 @@ def exposure_data_index(cluster_id):
 
 @app.route("/exposure_data/<cluster_id>/<file_name>", methods=['GET'])
 def exposure_data(cluster_id, file_name):
-    file_path = os.path.join(config.base_path, cluster_id, EXPOSURE_DATA_DIR, file_name)
+    identifier, suffix = split_file_name(file_name)
+    if suffix != SUFFIX_JSON:
+        return "ClusterID:%s, %s not found" % (cluster_id, file_name), HTTPStatus.NOT_FOUND
+
+    file_path = resolve_file_path(config.base_path, cluster_id, identifier, SUFFIX_JSON)
     if not os.path.exists(file_path):
         return "ClusterID:%s, %s not found" % (cluster_id, file_name), HTTPStatus.NOT_FOUND
 
-    with open(file_path, 'r') as fp:
-        content = fp.read()
-        return Response(
-            response=content,
-            status=HTTPStatus.OK,
-            mimetype=MIMETYPE_JSON
-        )
+    gzip_file_path = os.path.join(os.path.dirname(file_path), identifier + SUFFIX_JSON_GZIP)
+    # The quality, since gzip;q=0 refuses gzip.
+    if request.accept_encodings['gzip'] > 0 and os.path.exists(gzip_file_path):
+        response = send_file(gzip_file_path, mimetype=MIMETYPE_JSON, conditional=True)
+        response.content_encoding = 'gzip'
+    else:
+        # Streamed from disk instead of being read into memory.
+        response = send_file(file_path, mimetype=MIMETYPE_JSON, conditional=True)
 
+    response.vary.add('Accept-Encoding')
 
-def _convert_exposure_windows_to_csv(cluster_id, identifier, json_obj):
-    exposure_windows = json_obj['exposure_windows']
+    return response
 
-    if exposure_windows is None:
-        return "", HTTPStatus.NOT_FOUND
 
-    file_name = "%s-exposure_windows.csv" % identifier
-    file_path = os.path.join(config.base_path, cluster_id, EXPOSURE_DATA_DIR, file_name)
-    if not os.path.exists(file_path):
-        with open(file_path, mode='w') as fp:
-            writer = csv.writer(fp)
-            writer.writerow(
-                [
-                    "CalibrationConfidence", "DateMillisSinceEpoch", "WindowNumber", "Infectiousness", "ReportType",
-                    "MinAttenuationDb", "SecondsSinceLastScan", "TypicalAttenuationDb"
-                ])
-
-            for window_number, ew in enumerate(exposure_windows):
-                calibrationConfidence = ew["CalibrationConfidence"]
-                dateMillisSinceEpoch = ew["DateMillisSinceEpoch"]
-                infectiousness = ew["Infectiousness"]
-                reportType = ew["ReportType"]
-                for si in ew["ScanInstances"]:
-                    writer.writerow([
-                        calibrationConfidence, dateMillisSinceEpoch, window_number, infectiousness, reportType,
-                        si["MinAttenuationDb"], si["SecondsSinceLastScan"], si["TypicalAttenuationDb"],
-                    ])
-
-    return send_file(
-        file_path,
-        as_attachment=True,
-        attachment_filename=file_name,
-        mimetype=MIMETYPE_CSV
-    )
+# type -> suffix of the per-upload CSV cache
+CSV_CACHE_SUFFIXES = {
+    'exposure_windows.csv': SUFFIX_EXPOSURE_WINDOWS_CSV,
+    'daily_summaries.csv': SUFFIX_DAILY_SUMMARIES_CSV,
+}
 
 
-def _write_csv_row(dateMillisSinceEpoch, daily_summary, type, csv_writer):
-    summary = daily_summary[type]
-    if summary is not None:
-        csv_writer.writerow([
-            dateMillisSinceEpoch,
-            type,
-            summary["MaximumScore"],
-            summary["ScoreSum"],
-            summary["WeightedDurationSum"]
-        ])
+def _csv_response(chunks, file_name):
+    response = Response(chunks, mimetype=MIMETYPE_CSV)
+    response.headers['Content-Disposition'] = 'attachment; filename=%s' % file_name
+    return response
 
 
-def _convert_daily_summaries_to_csv(cluster_id, identifier, json_obj):
-    daily_summaries = json_obj['daily_summaries']
+def _write_csv_caches(store_dir, identifier, json_obj):
+    for type, (key, header, rows) in CSV_TYPES.items():
+        if json_obj.get(key) is None:
+            continue
+        file_name = identifier + CSV_CACHE_SUFFIXES[type]
+        for _ in publish_chunks(encode_csv(header, rows(json_obj[key])), store_dir, file_name):
+            pass
 
-    if daily_summaries is None:
-        return "", HTTPStatus.NOT_FOUND
 
-    file_name = "%s-daily_summaries.csv" % identifier
-    file_path = os.path.join(config.base_path, cluster_id, EXPOSURE_DATA_DIR, file_name)
-    if not os.path.exists(file_path):
-        with open(file_path, mode='w') as fp:
-            writer = csv.writer(fp)
-            writer.writerow(["DateMillisSinceEpoch", "Type", "MaximumScore", "ScoreSum", "WeightedDurationSum"])
-
-            for ds in daily_summaries:
-                dateMillisSinceEpoch = ds["DateMillisSinceEpoch"]
-                _write_csv_row(dateMillisSinceEpoch, ds, "DaySummary", writer)
-                _write_csv_row(dateMillisSinceEpoch, ds, "ConfirmedClinicalDiagnosisSummary", writer)
-                _write_csv_row(dateMillisSinceEpoch, ds, "ConfirmedTestSummary", writer)
-                _write_csv_row(dateMillisSinceEpoch, ds, "RecursiveSummary", writer)
-                _write_csv_row(dateMillisSinceEpoch, ds, "SelfReportedSummary", writer)
-
-    return send_file(
-        file_path,
-        as_attachment=True,
-        attachment_filename=file_name,
-        mimetype=MIMETYPE_CSV
-    )
+_csv_executor = None
+
+
+def _generate_csv_caches(store_dir, identifier, json_obj):
+    global _csv_executor
+
+    # Created on first use, so that no thread exists before uwsgi forks workers.
+    if _csv_executor is None:
+        _csv_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='csv')
+
+    future = _csv_executor.submit(_write_csv_caches, store_dir, identifier, json_obj)
+    future.add_done_callback(functools.partial(_log_csv_cache_error, identifier))
+
+
+def _log_csv_cache_error(identifier, future):
+    try:
+        future.result()
+    except Exception:
+        # The CSVs are still generated on their first download.
+        logger.exception('Generating the CSV files of %s failed.', identifier)
 
 
 @app.route("/exposure_data/<cluster_id>/<identifier>/<type>", methods=['GET'])
 def exposure_data_detail(cluster_id, identifier, type):
-    file_path = os.path.join(config.base_path, cluster_id, EXPOSURE_DATA_DIR, "%s.json" % identifier)
+    if not is_identifier(identifier) or type not in CSV_TYPES:
+        return "", HTTPStatus.NOT_FOUND
+
+    file_path = resolve_file_path(config.base_path, cluster_id, identifier, SUFFIX_JSON)
     if not os.path.exists(file_path):
         return "", HTTPStatus.NOT_FOUND
 
+    key, header, rows = CSV_TYPES[type]
+
+    # CSV caches are kept next to the JSON file, whichever layout it is stored in.
+    store_dir = os.path.dirname(file_path)
+    file_name = identifier + CSV_CACHE_SUFFIXES[type]
+    csv_file_path = os.path.join(store_dir, file_name)
+
+    if os.path.exists(csv_file_path):
+        return send_file(
+            csv_file_path,
+            as_attachment=True,
+            attachment_filename=file_name,
+            mimetype=MIMETYPE_CSV
+        )
+
     with open(file_path, 'r') as fp:
         json_obj = json.load(fp)
 
-        if type == 'exposure_windows.csv':
-            return _convert_exposure_windows_to_csv(cluster_id, identifier, json_obj)
-        elif type == 'daily_summaries.csv':
-            return _convert_daily_summaries_to_csv(cluster_id, identifier, json_obj)
+    if json_obj.get(key) is None:
+        return "", HTTPStatus.NOT_FOUND
+
+    # Concurrent misses each write their own temporary file; the cache is replaced only by a complete one.
+    return _csv_response(publish_chunks(encode_csv(header, rows(json_obj[key])), store_dir, file_name), file_name)
 
 
 def _is_valid_exposure_data(exposure_data):
@@ -306,12 +492,67 @@ def _is_valid_exposure_data(exposure_data):
     return True
 
 
-def _get_identifier(json_obj):
-    json_str = json.dumps(json_obj)
-    sha256 = hashlib.sha256()
-    sha256.update(json_str.encode('UTF-8'))
+def _encode_canonical(json_obj):
+    # Compact with sorted keys: the same exposure data always encodes to the same bytes.
+    return json.dumps(json_obj, separators=(',', ':'), sort_keys=True).encode('utf-8')
+
+
+def _get_identifier(content):
+    return hashlib.sha256(content).hexdigest()
 
-    return sha256.hexdigest()
+
+def _append_fields(content, fields):
+    """Appends fields to an encoded non-empty JSON object without re-encoding it."""
+    appended = b''.join(map(
+        lambda field: b',' + json.dumps(field[0]).encode('utf-8') + b':' + json.dumps(field[1]).encode('utf-8'),
+        fields.items()
+    ))
+    return content[:-1] + appended + b'}'
+
+
+def _index_exposure_data(cluster_id, identifier, created_timestamp, device):
+    """Returns the id of the new ExposureData, or None when it has already been indexed."""
+    session = Session()
+    try:
+        exposure_data = ExposureData(cluster_id=cluster_id, identifier=identifier, createdAt=created_timestamp,
+                                     device=device)
+        session.add(exposure_data)
+        session.commit()
+        return exposure_data.id
+    except IntegrityError:
+        # Indexed by a concurrent upload of the same data.
+        session.rollback()
+        return None
+    finally:
+        session.close()
+
+
+def _to_scan_instance_columns(json_obj):
+    if json_obj.get('exposure_windows') is None:
+        return None
+    return scan_instance_store.to_columns(json_obj['exposure_windows'])
+
+
+def _is_indexed(cluster_id, identifier):
+    session = Session()
+    try:
+        return session.query(ExposureData.id) \
+            .filter(ExposureData.cluster_id == cluster_id) \
+            .filter(ExposureData.identifier == identifier) \
+            .first() is not None
+    finally:
+        session.close()
+
+
+def _index_and_append(cluster_id, identifier, file_path, json_obj, scan_instance_columns):
+    created_timestamp = int(os.stat(file_path).st_mtime)
+
+    # Only the upload that indexed the data appends it, so that concurrent uploads add it to the datasets once.
+    exposure_data_id = _index_exposure_data(cluster_id, identifier, created_timestamp, json_obj.get('id'))
+    if exposure_data_id is not None:
+        append_datasets(config.base_path, cluster_id, identifier, created_timestamp, json_obj)
+        if scan_instance_columns is not None:
+            scan_instance_store.append(config.base_path, cluster_id, exposure_data_id, scan_instance_columns)
 
 
 @app.route("/exposure_data/<cluster_id>/", methods=['PUT'], strict_slashes=False)
@@ -326,11 +567,6 @@ def put_exposure_data(cluster_id):
     data = request.get_data()
     json_obj = json.loads(data)
 
-    # Sort
-    json_obj['exposure_informations'] = sort_exposure_informations(json_obj['exposure_informations'])
-    json_obj['daily_summaries'] = sort_daily_summaries(json_obj['daily_summaries'])
-    json_obj['exposure_windows'] = sort_exposure_windows(json_obj['exposure_windows'])
-
     if not _is_valid_exposure_data(json_obj):
         return Response(
             response='{}',
@@ -338,28 +574,74 @@ def put_exposure_data(cluster_id):
             mimetype=MIMETYPE_JSON
         )
 
-    output_dir = os.path.join(config.base_path, str(cluster_id), EXPOSURE_DATA_DIR)
-    os.makedirs(output_dir, exist_ok=True)
+    # Sort
+    for key, sort in [
+        ('exposure_informations', sort_exposure_informations),
+        ('daily_summaries', sort_daily_summaries),
+        ('exposure_windows', sort_exposure_windows),
+    ]:
+        if key in json_obj:
+            json_obj[key] = sort(json_obj[key])
 
-    identifier = _get_identifier(json_obj)
-    file_name = "%s.json" % identifier
+    # Added by this server. A re-uploaded download must hash like the original upload.
+    json_obj.pop('file_name', None)
+    json_obj.pop('url', None)
 
-    json_obj['file_name'] = file_name
-    json_obj['url'] = os.path.join(config.base_url, EXPOSURE_DATA_DIR, cluster_id, file_name)
+    content = _encode_canonical(json_obj)
+
+    identifier = _get_identifier(content)
+    file_name = identifier + SUFFIX_JSON
+
+    output_dir = get_shard_dir(config.base_path, cluster_id, identifier)
+    file_path = resolve_file_path(config.base_path, cluster_id, identifier, SUFFIX_JSON)
+
+    content = _append_fields(content, {
+        'file_name': file_name,
+        'url': os.path.join(config.base_url, EXPOSURE_DATA_DIR, cluster_id, file_name),
+    })
 
-    file_path = os.path.join(output_dir, file_name)
     if os.path.exists(file_path):
+        # Published by an upload whose indexing failed, e.g. on a locked database. Indexed by this retry.
+        if not _is_indexed(cluster_id, identifier):
+            try:
+                scan_instance_columns = _to_scan_instance_columns(json_obj)
+            except SCAN_INSTANCE_ERRORS:
+                return Response(
+                    response='{}',
+                    status=HTTPStatus.BAD_REQUEST,
+                    mimetype=MIMETYPE_JSON
+                )
+            _index_and_append(cluster_id, identifier, file_path, json_obj, scan_instance_columns)
+
         return Response(
-            response=json.dumps(json_obj),
+            response=content,
             status=HTTPStatus.OK,
             mimetype=MIMETYPE_JSON
         )
 
-    with open(file_path, mode='w') as fp:
-        json.dump(json_obj, fp, indent=4)
+    # Validated before anything is published, so that invalid data is never stored.
+    try:
+        scan_instance_columns = _to_scan_instance_columns(json_obj)
+    except SCAN_INSTANCE_ERRORS:
+        return Response(
+            response='{}',
+            status=HTTPStatus.BAD_REQUEST,
+            mimetype=MIMETYPE_JSON
+        )
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    # The sidecar first, so that it exists whenever the JSON file does.
+    publish_file(gzip.compress(content, compresslevel=GZIP_COMPRESS_LEVEL), output_dir, identifier + SUFFIX_JSON_GZIP)
+    file_path = publish_file(content, output_dir, file_name)
+
+    _index_and_append(cluster_id, identifier, file_path, json_obj, scan_instance_columns)
+
+    if config.exposure_data_eager_csv:
+        _generate_csv_caches(output_dir, identifier, json_obj)
 
     return Response(
-        response=json.dumps(json_obj),
+        response=content,
         status=HTTPStatus.CREATED,
         mimetype=MIMETYPE_JSON
     )